@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  alerts.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+''' User defined price alerts
+
+An alert (a row of the alerts table) fires once and is then deactivated:
+
+    above   the price crosses above value
+    below   the price crosses below value
+    move    the price moved by value percent or more within window seconds
+    order   the price comes within value percent of an open order
+
+Rules are indexed per (exchange, symbol) in lists of (value, id) sorted by
+value, so a price update costs a few bisections per symbol with rules
+whatever their number: crossings are the rules between the previous and the
+current price, moves and order distances are computed once per symbol and
+cut the list at that size.
+'''
+
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from time import time
+
+KINDS = ('above', 'below', 'move', 'order')
+
+# alerts row: id, exchange, symbol, kind, value, window, active, created, triggered
+COLUMNS = ('id', 'exchange', 'symbol', 'kind', 'value', 'window', 'active', 'created', 'triggered')
+
+INF = float('inf')
+
+def format_alert(rule, price):
+
+    id, exchange, symbol, kind, value, window = rule[:6]
+
+    if kind == 'move':
+        condition = 'moved {:g}% in {}s'.format(value, window)
+    elif kind == 'order':
+        condition = 'within {:g}% of an order'.format(value)
+    else:
+        condition = '{} {:.9f}'.format(kind, value).rstrip('0')
+
+    return "{}: {} {} ({:.9f})".format(exchange, symbol, condition, price)
+
+class Alerts(object):
+
+    def __init__(self):
+
+        self.rules = {}
+        # (exchange, symbol): {kind: [(value, id)]}, moves as {('move', window): [...]}
+        self.index = {}
+        # exchange: symbols with rules
+        self.symbols = {}
+        self.last = {}
+        # (exchange, symbol): deque of (time, price) for move rules
+        self.history = {}
+        # account: (exchange, {symbol: [order price]})
+        self.orders = {}
+
+    def load(self, rows):
+
+        ''' Index active rows of the alerts table '''
+
+        for row in rows:
+            if row[6]:
+                self.add(row)
+
+    def add(self, row):
+
+        id, exchange, symbol, kind, value, window = row[:6]
+        key = (exchange, symbol)
+
+        self.rules[id] = tuple(row)
+        self.symbols.setdefault(exchange, set()).add(symbol)
+        rules = self.index.setdefault(key, {})
+        insort(rules.setdefault(self.slot(row), []), (value, id))
+
+    def remove(self, id):
+
+        row = self.rules.pop(id, None)
+        if row is None:
+            return
+
+        key = (row[1], row[2])
+        rules = self.index[key]
+        slot = self.slot(row)
+        rules[slot].remove((row[4], id))
+
+        if not rules[slot]:
+            del rules[slot]
+        if not rules:
+            del self.index[key]
+            self.symbols[row[1]].discard(row[2])
+            self.history.pop(key, None)
+
+        return row
+
+    def slot(self, row):
+
+        return ('move', row[5]) if row[3] == 'move' else row[3]
+
+    def set_orders(self, account, exchange, orders):
+
+        if orders is None:
+            return
+
+        prices = {}
+        for order in orders:
+            prices.setdefault(order.symbol, []).append(float(order.price))
+
+        self.orders[account] = (exchange, prices)
+
+    def check(self, exchange, prices, now=None):
+
+        ''' Return [(rule, price)] fired by prices, removing them '''
+
+        if now is None:
+            now = time()
+
+        fired = []
+
+        for symbol in list(self.symbols.get(exchange, ())):
+            price = prices.get(symbol)
+            if not price:
+                continue
+
+            price = float(price)
+            key = (exchange, symbol)
+            previous = self.last.get(key)
+            self.last[key] = price
+
+            for slot, rules in self.index[key].items():
+                if slot == 'above':
+                    if previous is not None and price > previous:
+                        ids = rules[bisect_right(rules, (previous, INF)):bisect_right(rules, (price, INF))]
+                    else:
+                        continue
+                elif slot == 'below':
+                    if previous is not None and price < previous:
+                        ids = rules[bisect_left(rules, (price,)):bisect_left(rules, (previous,))]
+                    else:
+                        continue
+                elif slot == 'order':
+                    distance = self.distance(exchange, symbol, price)
+                    if distance is None:
+                        continue
+                    ids = rules[bisect_left(rules, (distance,)):]
+                else:
+                    move = self.move(key, slot[1], price, now)
+                    if move is None:
+                        continue
+                    ids = rules[:bisect_right(rules, (move, INF))]
+
+                fired.extend((self.rules[id], price) for value, id in ids)
+
+        for rule, price in fired:
+            self.remove(rule[0])
+
+        return fired
+
+    def distance(self, exchange, symbol, price):
+
+        ''' Return percent distance of price to the nearest open order '''
+
+        distances = [
+            abs(price - order) / order * 100
+            for account_exchange, orders in self.orders.values()
+            if account_exchange == exchange
+            for order in orders.get(symbol, ())
+            if order
+        ]
+
+        return min(distances, default=None)
+
+    def move(self, key, window, price, now):
+
+        ''' Return percent move of price since `window` seconds ago '''
+
+        history = self.history.setdefault(key, deque())
+        # once per update, whatever the number of windows
+        if not history or history[-1][0] != now:
+            history.append((now, price))
+
+        longest = max(slot[1] for slot in self.index[key] if isinstance(slot, tuple))
+        while history and history[0][0] < now - longest:
+            history.popleft()
+
+        reference = next((value for at, value in history if at >= now - window), None)
+        if not reference:
+            return
+
+        return abs(price / reference - 1) * 100
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  bench.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+''' End-to-end benchmark of the polling cycle against fakeexchange.py
+
+    python3 bench.py --symbols 10 100 1000 10000 --accounts 1 10 --cycles 20
+
+Every run polls HitBTC and Ccex clients (one pair per account) through
+btc.update() into a temporary database and reports cycle, get_data and
+load_to_db latency percentiles, database write throughput and memory.
+'''
+
+import argparse
+import asyncio
+import os
+import resource
+import shutil
+import tempfile
+import tracemalloc
+from time import perf_counter
+
+import btc
+import clients
+import db
+from fakeexchange import FakeExchange
+from notifier import Notifier
+from timeseries import TimeSeries
+
+def percentile(values, p):
+
+    values = sorted(values)
+
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def timed(function, timings):
+
+    async def wrapper(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        finally:
+            timings.append(perf_counter() - start)
+
+    return wrapper
+
+async def send(text):
+
+    return {'ok': True}
+
+async def run(symbols, accounts, cycles, latency, errors, port, trace):
+
+    exchange = FakeExchange(symbols=symbols, latency=latency, errors=errors, seed=1)
+    await exchange.start(port=port)
+
+    tmp = tempfile.mkdtemp()
+    db.DB = os.path.join(tmp, 'btc.db')
+    await db.init_db()
+    btc.series = TimeSeries(os.path.join(tmp, 'timeseries'))
+    btc.notifier = Notifier(send)
+
+    timings = {'cycle': [], 'get_data': [], 'load_to_db': []}
+    written = [0]
+
+    def count(table, name, changes):
+        written[0] += len(changes['inserted']) + len(changes['updated']) + len(changes['removed'])
+
+    db.subscribe(count)
+
+    load_to_db = btc.load_to_db
+    btc.load_to_db = timed(load_to_db, timings['load_to_db'])
+
+    polled = []
+    base = 'http://localhost:{}'.format(port)
+
+    try:
+        for i in range(accounts):
+            for client in (
+                clients.HitBTC(api_url=base, login='key', password='secret'),
+                clients.Ccex(api_url=base + '/t', login='key', password='secret'),
+            ):
+                client.name = '{}{}'.format(client.name, i)
+                client.get_data = timed(client.get_data, timings['get_data'])
+                polled.append(client)
+
+        if trace:
+            tracemalloc.start()
+
+        for cycle in range(cycles):
+            start = perf_counter()
+            await asyncio.gather(*(btc.update(client) for client in polled))
+            timings['cycle'].append(perf_counter() - start)
+    finally:
+        peak = tracemalloc.get_traced_memory()[1] if trace else 0
+        tracemalloc.stop()
+        btc.load_to_db = load_to_db
+        db.unsubscribe(count)
+        await clients.close_sessions()
+        await db.close()
+        await exchange.stop()
+        shutil.rmtree(tmp)
+
+    report = [symbols, accounts]
+    for name in ('cycle', 'get_data', 'load_to_db'):
+        report += [1000 * percentile(timings[name], p) for p in (50, 90, 99)]
+    report.append(written[0] / sum(timings['load_to_db']))
+    report.append(peak / 2 ** 20)
+    report.append(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+    return report
+
+async def main(args):
+
+    print("{:>7} {:>8} | {:^23} | {:^23} | {:^23} | {:>10} {:>8} {:>8}".format(
+        'symbols', 'accounts', 'cycle ms p50/p90/p99', 'get_data ms', 'load_to_db ms', 'rows/s', 'peak MB', 'rss MB'))
+
+    for symbols in args.symbols:
+        for accounts in args.accounts:
+            report = await run(symbols, accounts, args.cycles, args.latency, args.errors, args.port, args.trace_memory)
+            print("{:7} {:8} | {:7.1f} {:7.1f} {:7.1f} | {:7.1f} {:7.1f} {:7.1f} | {:7.1f} {:7.1f} {:7.1f} | {:10.0f} {:8.1f} {:8.1f}".format(*report))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the polling cycle against a fake exchange')
+    parser.add_argument('--symbols', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('--accounts', type=int, nargs='+', default=[1, 10])
+    parser.add_argument('--cycles', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--errors', type=float, default=0)
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--trace-memory', action='store_true', help='report peak python heap (slower)')
+    args = parser.parse_args()
+
+    asyncio.get_event_loop().run_until_complete(main(args))
@@ -20,54 +20,95 @@
 #
 #
 
-from clients import HitBTC, Ccex
+from clients import get_adapter, get_ticker, register, configure_sessions, get_session, close_sessions, set_precision, set_decoder, set_offload
 import asyncio
 import logging
+import random
+import signal
 from os import path
 import json
-import aiohttp
-from aiosocks.connector import ProxyConnector, ProxyClientRequest
-import aiosqlite
 import db
-from web import web_app
+import web
+import metrics
+from notifier import Notifier
+from alerts import Alerts, format_alert
+from snapshot import Snapshot
+from profiling import Profiler
+from timeseries import TimeSeries, TOTAL
 
 logging.basicConfig()
+logger = logging.getLogger('btc')
 #DB = 'btc.db'
 CFG = 'btc.cfg'
 
 config = {}
+notifier = None
+alerts = None
+series = None
+valuation = None
+snapshot = None
+supervisor = None
+# exchange: prices dict last stored, see load_prices()
+_loaded_prices = {}
+# account: rows of orders near the market, see load_to_db()
+_near = {}
+# exchange: symbols of alerts its ticker was told to fetch, see want_alert_symbols()
+_alert_symbols = {}
 config_path = path.expanduser(CFG)
 
-with open(config_path) as json_data_file:
-    try:
-        config = json.load(json_data_file)
-    except Exception as e:
-        print(e)
+if path.exists(config_path):
+    with open(config_path) as json_data_file:
+        try:
+            config = json.load(json_data_file)
+        except Exception as e:
+            print(e)
 
 async def telegram_send_message(text):
 
     url = "https://api.telegram.org/bot{}/".format(config.get('telegram').get('token'))
     chat_id = config.get('telegram').get('chat_id')
-
-    conn = ProxyConnector()
-
-    proxy = "socks5://localhost:9050"
+    proxy = config.get('telegram').get('proxy', "socks5://localhost:9050")
 
     if url and chat_id:
         try:
             params = {'chat_id': chat_id, 'text': text}
-            async with aiohttp.ClientSession(connector=conn, request_class=ProxyClientRequest) as session:
-                async with session.get(url + 'sendMessage', proxy=proxy, params=params) as resp:
-                    if resp.status == 200:
-                        return await resp.json()
+            session = get_session(proxy)
+            async with session.get(url + 'sendMessage', proxy=proxy, params=params) as resp:
+                if resp.status == 200:
+                    return await resp.json()
         except Exception as e:
             print(e)
 
-def create_client(exchange, loop):
+def get_accounts(exchange):
+
+    ''' Return the accounts of exchange as {'name', 'public_key', 'secret'}
+
+    The keys of the exchange itself are its main account, named after the
+    exchange; more can be listed in "accounts", named "<exchange>:<name>".
+    '''
+
+    accounts = []
+
+    if exchange.get('public_key') and exchange.get('secret'):
+        accounts.append({
+            'name': exchange.get('name'),
+            'public_key': exchange.get('public_key'),
+            'secret': exchange.get('secret'),
+        })
+
+    for account in exchange.get('accounts', []):
+        accounts.append(dict(account, name='{}:{}'.format(exchange.get('name'), account.get('name'))))
+
+    return accounts
+
+def create_client(exchange, loop, account=None):
+
+    if account is None:
+        account = dict(exchange)
 
     url = exchange.get('url')
-    public_key = exchange.get('public_key')
-    secret = exchange.get('secret')
+    public_key = account.get('public_key')
+    secret = account.get('secret')
     api_url = exchange.get('api')
     name = exchange.get('name')
     timeout = exchange.get('timeout', 5)
@@ -75,97 +116,420 @@ def create_client(exchange, loop):
     if not (public_key and secret):
         return
 
+    kwargs = {}
+    if exchange.get('stream'):
+        kwargs['stream'] = True
+    if exchange.get('ws'):
+        kwargs['ws_url'] = exchange.get('ws')
+    if exchange.get('proxy'):
+        kwargs['proxy'] = exchange.get('proxy')
+    if exchange.get('adaptive') is not None:
+        kwargs['adaptive'] = exchange.get('adaptive')
+    if exchange.get('near_band') is not None:
+        kwargs['near_band'] = exchange.get('near_band')
+    for option in ('deadlines', 'hedge', 'breaker'):
+        if exchange.get(option) is not None:
+            kwargs[option] = exchange.get(option)
+
+    if exchange.get('module'):
+        register(name, exchange.get('module'))
+
+    if config.get('valuation'):
+        kwargs['bases'] = config.get('valuation').get('bases', ())
+
+    # accounts of an exchange share one ticker fetched at most twice a period,
+    # served up to "ticker_stale" seconds late while refreshing, with "subset"
+    # only wanted symbols in between full feeds that often
+    ticker = get_ticker(
+        name,
+        exchange.get('ticker_ttl', exchange.get('refresh', 5) / 2),
+        exchange.get('subset'),
+        exchange.get('ticker_stale', 0),
+    )
+
     try:
-        client = globals()[name](url=url, api_url=api_url, login=public_key, password=secret, timeout=timeout, loop=loop)
+        client = get_adapter(name)(url=url, api_url=api_url, login=public_key, password=secret, timeout=timeout, loop=loop, name=account.get('name'), ticker=ticker, **kwargs)
     except Exception as e:
         print(name + str(e))
         return
 
     return client
 
+async def load_prices(exchange, prices, fresh=None):
+
+    ''' Store prices of exchange unless this very dict is stored already
+
+    fresh is the part of prices just fetched (see clients.Ticker), the only
+    one sampled into the time series and checked against alerts.
+    '''
+
+    if not prices or _loaded_prices.get(exchange) is prices:
+        return
+
+    _loaded_prices[exchange] = prices
+
+    if fresh is None:
+        fresh = prices
+
+    await db.set_prices(exchange, prices)
+    series.add_many(exchange, fresh)
+
+    if valuation:
+        valuation.set_prices(exchange, prices)
+
+    if alerts:
+        await check_alerts(exchange, fresh)
+        want_alert_symbols(exchange)
+
+def want_alert_symbols(exchange):
+
+    ''' Have the ticker of exchange fetch the symbols with alerts every time '''
+
+    symbols = frozenset(alerts.symbols.get(exchange, ()))
+
+    if _alert_symbols.get(exchange) == symbols:
+        return
+
+    _alert_symbols[exchange] = symbols
+
+    if supervisor:
+        supervisor.want(exchange, symbols)
+    else:
+        get_ticker(exchange).want('alerts', symbols)
+
+async def check_alerts(exchange, prices):
+
+    fired = alerts.check(exchange, prices)
+
+    for rule, price in fired:
+        notifier.put_alert(rule[0], exchange, format_alert(rule, price))
+
+    await db.set_alerts_triggered([rule[0] for rule, price in fired])
+
 async def load_to_db(name, data):
 
-    await db.set_prices(name, data.get('prices'))
+    ''' Store data of account name
+
+    Prices are stored per exchange. Data from a worker process may leave
+    them out as already sent. What failed to be fetched is None and keeps its last stored value.
+    '''
+
+    if alerts:
+        alerts.set_orders(name, data.get('exchange', name), data.get('orders'))
+
+    await load_prices(data.get('exchange', name), data.get('prices'), data.get('fresh'))
     await db.set_orders(name, data.get('orders'))
     await db.set_history(name, data.get('history'))
-    #db.set_total(name, data.get('total'))
-
-async def check_history():
-
-    for row in await db.get_history_confirmed():
-        message = "{}: {} {} {} for {:.9f}".format(
-            row[1], #exchange
-            row[2], #symbol
-            row[3], #side
-            row[5], #quantity
-            row[4], #price
-        )
-        response = await telegram_send_message(message)
-        if response and response.get('ok'):
-            await db.set_history_confirmed(row[0], row[1])
+
+    if data.get('cursor'):
+        await db.set_cursor(name, data.get('cursor'))
+
+    if data.get('near') is not None:
+        _near[name] = [
+            (order.id, name, order.symbol, order.side, float(order.price), float(order.quantity), float(market), distance)
+            for order, market, distance in data.get('near')
+        ]
+        publish_near()
+
+    if data.get('total') is not None:
+        # kept by the time series only, the total table would grow every cycle
+        series.add(name, TOTAL, float(data.get('total')))
+
+    if valuation:
+        if data.get('balance') is not None:
+            valuation.set_balance(name, data.get('balance'))
+        result = valuation.compute()
+        web.cache.update(valuation=result)
+        series.add_many('consolidated', {TOTAL + '_' + base: value for base, value in result['total'].items()})
+
+    if snapshot:
+        snapshot.record(name, data, _near.get(name))
+        web.cache.update(status=snapshot.status())
+        snapshot.save(notifier.unsent())
+
+def publish_near():
+
+    web.cache.update(near=sorted((row for rows in _near.values() for row in rows), key=lambda row: row[-1]))
+
+async def warm_start():
+
+    ''' Serve the last snapshot until the first cycles, see snapshot.py '''
+
+    if not snapshot.load():
+        return
+
+    for exchange, prices in snapshot.prices.items():
+        if valuation:
+            valuation.set_prices(exchange, prices)
+
+    for name, account in snapshot.accounts.items():
+        orders = snapshot.get_orders(name)
+        if orders is not None:
+            alerts.set_orders(name, account['exchange'], orders)
+        balance = snapshot.get_balance(name)
+        if valuation and balance is not None:
+            valuation.set_balance(name, balance)
+        if account.get('near') is not None:
+            _near[name] = [tuple(row) for row in account['near']]
+
+    publish_near()
+    web.cache.update(status=snapshot.status())
+    if valuation:
+        web.cache.update(valuation=valuation.compute())
+
+    for item in snapshot.unsent:
+        notifier.enqueue(*item)
+
+    await check_history()
+
+    logger.info("warm start from {} accounts".format(len(snapshot.accounts)))
+
+async def check_history(name=None):
+
+    for row in await db.get_history_confirmed(name):
+        notifier.put(row)
+
+def format_price(price):
+
+    return "{:.9f}".format(price).rstrip('0')
 
 def show(name, data):
 
-    print("{}: {}".format(name, data.get('total')))
+    print("{}: {}".format(name, format_price(data.get('total'))))
     print("orders:")
     for order in data.get('orders'):
-        symbol = order.get('symbol')
-        side = order.get('side')
-        quantity = order.get('quantity')
-        price = order.get('price')
-        cur_price = data.get('prices').get(symbol)
-        print("{:9} {:4} {:5} for {:11} ({})".format(symbol, side, quantity, price, cur_price))
+        cur_price = data.get('prices').get(order.symbol)
+        print("{:9} {:4} {:5.2f} for {:11} ({})".format(order.symbol, order.side, order.quantity, format_price(order.price), format_price(cur_price or 0)))
 
     print("-------")
     print("filled:")
     for order in data.get('history'):
-        symbol = order.get('symbol')
-        side = order.get('side')
-        quantity = order.get('quantity')
-        price = order.get('price')
-        status = order.get('status')
-        date = order.get('updatedAt').split('.')[0].replace('T', ' ')
-        if status == "filled":
-            print("{} {:9} {:4} {:5} for {:11}".format(date, symbol, side, quantity, price))
+        date = (order.updated or '').split('.')[0].replace('T', ' ')
+        if order.status == "filled":
+            print("{} {:9} {:4} {:5.2f} for {:11}".format(date, order.symbol, order.side, order.quantity, format_price(order.price)))
     print()
 
-async def update(clients):
+async def update(client):
 
-    for client in clients:
-        data = await client.get_data()
-        await load_to_db(client.name, data)
+    data = await client.get_data()
+    await load_to_db(client.name, data)
+    # only move on once the fills before it are stored
+    client.history_cursor = data.get('cursor')
+    await web.refresh()
+    await check_history(client.name)
 
-    await check_history()
+async def poll(client, period, semaphore, jitter=0.1, max_backoff=300, trace_path=None, handler=update, near_period=None, profiler=None, budget=None):
+
+    ''' Poll one client forever on its own drift-free schedule
+
+    Ticks are spaced exactly `period` seconds apart, each one shifted by a
+    random jitter of up to `jitter * period` so that exchanges with the same
+    refresh don't fire together. A poll that fails or overruns its period
+    backs off exponentially up to `max_backoff` seconds. `semaphore` caps the
+    number of polls in flight across all clients. With `trace_path` the
+    timings of every cycle are appended to that file. handler(client) runs
+    one cycle. While the client has orders near the market the period is
+    `near_period` if given. A cycle longer than `budget` seconds (default
+    `period`) writes the samples of `profiler` taken meanwhile.
+    '''
+
+    loop = asyncio.get_event_loop()
+    tick = loop.time()
+    backoff = 0
+
+    while True:
+        delay = tick + random.uniform(0, period * jitter) - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        start = loop.time()
+        failed = False
+        trace = metrics.start_trace() if trace_path else None
+
+        try:
+            async with semaphore:
+                await handler(client)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("{}: {}".format(client.name, e))
+            failed = True
+
+        now = loop.time()
+        metrics.CYCLE_SECONDS.observe(now - start, exchange=client.name)
+
+        if trace is not None:
+            metrics.dump_trace(trace_path, client.name, trace, now - start)
+
+        if profiler and now - start > (budget or period):
+            filename = profiler.dump(client.name, start, now)
+            if filename:
+                logger.warning("{}: cycle took {:.1f}s, profile in {}".format(client.name, now - start, filename))
+
+        if failed or now - start > period:
+            backoff = min(max(backoff * 2, period), max_backoff)
+            logger.warning("{}: poll took {:.1f}s, next in {:.1f}s".format(client.name, now - start, backoff))
+            tick = now + backoff
+        else:
+            backoff = 0
+            interval = near_period if near_period and client.monitor.near else period
+            tick += interval
+            if tick < now:
+                tick += (now - tick) // interval * interval + interval
+
+def start_polls(config, jobs, loop, handler=update, profiler=None):
+
+    ''' Create the clients of (exchange, account, cursor) jobs and poll them
 
-async def periodic_update(clients, period):
+    Return (clients, poll tasks).
+    '''
+
+    semaphore = asyncio.Semaphore(config.get('max_polls', 4))
+
+    clients = []
+    tasks = []
+    for exchange, account, cursor in jobs:
+        client = create_client(exchange, loop, account)
+        if not client:
+            continue
+        client.history_cursor = cursor
+        clients.append(client)
+        tasks.append(asyncio.ensure_future(poll(
+            client,
+            period=exchange.get('refresh', 5),
+            semaphore=semaphore,
+            jitter=exchange.get('jitter', 0.1),
+            trace_path=config.get('metrics', {}).get('trace'),
+            handler=handler,
+            near_period=exchange.get('near_refresh'),
+            profiler=profiler,
+            budget=exchange.get('budget', (config.get('profile') or {}).get('budget')),
+        )))
+
+    return clients, tasks
+
+async def consume(supervisor):
+
+    ''' Store the data polled by worker processes '''
 
     while True:
-        await update(clients)
-        await asyncio.sleep(period)
+        name, data = await supervisor.get()
+        try:
+            await load_to_db(name, data)
+            # only now may the worker move the cursor past these fills
+            supervisor.stored(name, data.get('cursor'))
+            await web.refresh()
+            await check_history(name)
+        except Exception as e:
+            logger.error("{}: {}".format(name, e))
+
+def start_profiler(config, loop):
+
+    ''' Return the running Profiler if "profile" is enabled, see profiling.py '''
+
+    options = dict(config.get('profile') or {})
+
+    if not options.pop('enabled', 0):
+        return
+
+    options.pop('budget', None)
+    profiler = Profiler(**options)
+    profiler.start(loop)
+
+    return profiler
 
 async def main(loop):
 
+    global notifier, series, valuation, alerts, snapshot, supervisor
+
     await db.init_db()
 
-    clients = []
+    options = config.get('timeseries', {})
+    series = TimeSeries(path=options.get('path', 'timeseries'), retention=options.get('retention'))
+
+    telegram = config.get('telegram')
+    notifier = Notifier(
+        telegram_send_message,
+        window=telegram.get('window', 2),
+        rate=telegram.get('rate', 1),
+        retries=telegram.get('retries', 5),
+    )
+    notifier.start()
+
+    alerts = Alerts()
+    alerts.load(await db.get_alerts(active=True))
+
+    configure_sessions(**config.get('http', {}))
+    set_precision(config.get('precision', 'float'))
+    set_decoder(**config.get('json', {}))
+    set_offload(config.get('offload', ()))
+
+    profiler = start_profiler(config, loop)
+
+    if config.get('valuation'):
+        # needs numpy
+        from valuation import Valuation
+        valuation = Valuation(bases=config.get('valuation').get('bases', ('BTC', 'USD', 'ETH')))
+
+    # "snapshot": null turns the warm start off
+    options = config.get('snapshot', {})
+    if options is not None:
+        snapshot = Snapshot(path=options.get('path', 'snapshot.json'), interval=options.get('interval', 10))
+        await warm_start()
+
+    jobs = []
     for exchange in config.get('exchanges').values():
         if exchange.get('enabled'):
-            client = create_client(exchange, loop)
-            clients.append(client)
+            for account in get_accounts(exchange):
+                jobs.append((exchange, account, await db.get_cursor(account['name'])))
 
-    await web_app()
-    await periodic_update(clients, 5)
+    clients = []
+    runner = None
+    if config.get('workers'):
+        from shards import Supervisor
+        supervisor = Supervisor(config, jobs, config.get('workers'))
+        supervisor.start()
+        tasks = [asyncio.ensure_future(consume(supervisor))]
+    else:
+        clients, tasks = start_polls(config, jobs, loop, profiler=profiler)
+
+    tasks.append(asyncio.ensure_future(series.maintain()))
+    tasks.append(asyncio.ensure_future(metrics.monitor_loop_lag(config.get('metrics', {}).get('lag_interval', 0.5))))
 
-    # try:
-        # await future
-    # except Exception as e:
-        # for client in clients:
-            # await client.close()
-        # loop.close()
+    try:
+        runner = await web.web_app(series, alerts)
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if supervisor:
+            supervisor.stop()
+        for client in clients:
+            await client.close()
+        if snapshot:
+            await snapshot.close(notifier.unsent())
+        await notifier.stop()
+        series.close()
+        if runner:
+            await runner.cleanup()
+        if profiler:
+            profiler.stop()
+        await close_sessions()
+        await db.close()
 
     return 0
 
 if __name__ == '__main__':
 
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(main(loop))
+    task = loop.create_task(main(loop))
+
+    # stop polling, then save and close everything in main()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, task.cancel)
+
+    try:
+        loop.run_until_complete(task)
+    except asyncio.CancelledError:
+        pass
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  ccex.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+import asyncio
+import hmac
+from time import time
+from yarl import URL
+import clients
+from clients import Balance, Order, Exchange, ApiError
+
+def keep_last(pair):
+
+    symbol, values = pair
+    if isinstance(values, dict) and values.get('lastprice'):
+        return symbol, values['lastprice']
+
+class Ccex(Exchange):
+
+    # a subset costs one request per pair
+    MAX_SUBSET = 10
+
+    def __init__(self, url="https://c-cex.com", api_url="https://c-cex.com/t", *args, **kwargs):
+
+        super().__init__(url, api_url, *args, **kwargs)
+
+    async def get_response(
+        self,
+        method='GET',
+        url=None,
+        params={},
+        headers={},
+        auth=None,
+        endpoint=None,
+        keep=None,
+    ):
+
+        if endpoint is None:
+            endpoint = params.get('a') or url.rsplit('/', 1)[-1]
+
+        params.update({
+            'apikey': self.login,
+            'nonce': int(time()),
+        })
+
+        url = URL(url).with_query(params)
+
+        if auth:
+            signature = hmac.new(
+                key=self.password.encode(),
+                msg=str(url).encode(),
+                digestmod='sha512',
+            ).hexdigest()
+
+            headers['apisign'] = signature
+
+        # a signed request's nonce is single use, only public ones are hedged
+        return await self.request(
+            method,
+            str(url),
+            endpoint,
+            keep=keep,
+            hedge=method == 'GET' and not auth,
+            signed=auth,
+            headers=headers,
+        )
+
+    def decode(self, endpoint, status, body):
+
+        ''' Unwrap api.html answers, *.json ones are the data unless an error '''
+
+        jresp = super().decode(endpoint, status, body)
+
+        if endpoint.endswith('json') and 'success' not in jresp:
+            return jresp
+
+        if not jresp.get('success'):
+            raise ApiError('{}: {}'.format(endpoint, jresp.get('message')))
+
+        return jresp.get('result')
+
+    async def get_balance(self):
+
+        ''' Return non-zero balance '''
+
+        ret = {}
+
+        balances = await self.get_response(
+            url="{}/api.html".format(self.api_url),
+            params={'a': 'getbalances'},
+            auth=True
+        )
+
+        if balances:
+            for x in balances:
+                # Balance is the total, Available part of it
+                balance = Balance(x['Currency'], x['Available'], 0)
+                balance.reserved = clients.number(x['Balance']) - balance.available
+                if balance.available > 0 or balance.reserved > 0:
+                    ret[balance.currency] = balance
+
+        return ret
+
+    async def get_orders(self):
+
+        ''' Return active orders '''
+
+        ret = []
+
+        orders = await self.get_response(
+            url="{}/api.html".format(self.api_url),
+            params={'a': 'getopenorders'},
+            auth=True
+        )
+
+        if orders:
+            for x in orders:
+                ret.append(Order(
+                    id=x['OrderUuid'],
+                    symbol=x['Exchange'],
+                    side='buy' if x['OrderType'] == 'LIMIT_BUY' else 'sell',
+                    quantity=x['Quantity'],
+                    price=x['Limit'],
+                ))
+
+        return ret
+
+    async def get_history(self, count=20, cursor=None, max_count=1000):
+
+        ''' Return order history
+
+        Without a cursor the last `count` orders. With a cursor (TimeStamp of
+        the newest known order) the orders from that time on: the API has no
+        time filter, so the count is doubled until the answer reaches back to
+        the cursor.
+        '''
+
+        if cursor:
+            count = 10
+
+        while True:
+            trade = await self.get_response(
+                url="{}/api.html".format(self.api_url),
+                params={'a': 'getorderhistory', 'count': count},
+                auth=True,
+            )
+
+            if not cursor or len(trade) < count or count >= max_count:
+                break
+            if min(x['TimeStamp'] for x in trade) < cursor:
+                break
+
+            count = min(count * 2, max_count)
+
+        ret = []
+
+        if trade:
+            for x in trade:
+                if cursor and x['TimeStamp'] < cursor:
+                    continue
+                order = Order(
+                    id=x['OrderUuid'],
+                    symbol=x['Exchange'],
+                    side='buy' if x['OrderType'] == 'LIMIT_BUY' else 'sell',
+                    quantity=x['Quantity'],
+                    price=x['PricePerUnit'],
+                    status='filled' if x['QuantityRemaining'] == 0 else 'other',
+                    updated=x['TimeStamp'],
+                )
+                if order.side == 'buy' and order.price:
+                    order.quantity = order.quantity / order.price
+                ret.append(order)
+
+        return ret
+
+    async def get_prices(self, symbols=None):
+
+        ''' Return prices, of the given symbols only with a request per pair '''
+
+        ret = {}
+
+        if symbols:
+            symbols = sorted(symbols)
+            tickers = await asyncio.gather(*(
+                self.get_response(url="{}/{}.json".format(self.api_url, symbol), params={}, endpoint='pair.json')
+                for symbol in symbols
+            ))
+            if not all(tickers):
+                return ret
+            prices = {symbol: ticker.get('ticker', {}) for symbol, ticker in zip(symbols, tickers)}
+        elif clients.stream:
+            pairs = await self.get_response(url="{}/prices.json".format(self.api_url), keep=keep_last)
+            return {symbol: clients.number(price) for symbol, price in pairs or ()}
+        else:
+            prices = await self.get_response(url="{}/prices.json".format(self.api_url))
+
+        if prices:
+            for symbol, values in prices.items():
+                price = values.get('lastprice')
+                if price:
+                    ret[symbol] = clients.number(price)
+
+        return ret
+
+    def symbol(self, currency, base):
+
+        return (currency + '-' + base).lower()
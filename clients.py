@@ -22,268 +22,723 @@
 #
 #
 
-from aiohttp import BasicAuth, ClientSession
+from aiohttp import ClientSession, TCPConnector
 import logging
 from time import time
-import hmac
 import asyncio
-from yarl import URL
-import uuid
+import codecs
+import importlib
+import json
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from time import perf_counter
+import metrics
 
-class Ccex(object):
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-    def __init__(
-        self,
-        url="https://c-cex.com",
-        api_url="https://c-cex.com/t",
-        login=None,
-        password=None,
-        timeout=5,
-        loop=None,
-        log=None,
-    ):
+# exchange name in btc.cfg: module with the adapter class of that name,
+# imported on first use, see get_adapter(). An exchange in btc.cfg may name
+# its own module with "module".
+ADAPTERS = {
+    'HitBTC': 'hitbtc',
+    'Ccex': 'ccex',
+}
 
-        self.url = url
-        self.api_url = api_url
-        self.login = login
-        self.password = password
-        self.name = self.__class__.__name__
-        self.logger = logging.getLogger(self.name)
-        if log:
-            self.logger.setLevel(log)
+# setuptools entry point group of adapters installed as packages
+ENTRY_POINTS = 'btc.exchanges'
 
-        if not loop:
-            loop = asyncio.get_event_loop()
+SESSION_OPTIONS = {
+    'limit': 100,
+    'limit_per_host': 8,
+    'ttl_dns_cache': 300,
+    'keepalive_timeout': 60,
+}
 
-        self.loop = loop
+_sessions = {}
+_tickers = {}
+_breakers = {}
 
-        self.session = ClientSession(loop=self.loop)
-        self.timeout = timeout
+# float or Decimal, see set_precision()
+number = float
 
-    async def get_response(
-        self,
-        method='GET',
-        url=None,
-        params={},
-        headers={},
-        auth=None,
-    ):
+# response decoder and whether tickers are decoded item by item, see set_decoder()
+loads = orjson.loads if orjson else json.loads
+stream = False
 
-        params.update({
-            'apikey': self.login,
-            'nonce': int(time()),
-        })
+# HTTP statuses of an exchange shedding load: failures, not errors of the request
+OVERLOADED = (408, 429)
 
-        url = URL(url).with_query(params)
+CHUNK_SIZE = 65536
+WHITESPACE = ' \t\n\r'
+# characters a number cut at a chunk boundary may go on with
+NUMBER = set('0123456789.eE+-')
 
-        if auth:
-            signature = hmac.new(
-                key=self.password.encode(),
-                msg=str(url).encode(),
-                digestmod='sha512',
-            ).hexdigest()
+_decoder = json.JSONDecoder()
 
-            headers['apisign'] = signature
+# CPU heavy steps run in _executor, see set_offload()
+_offload = set()
+_executor = None
 
-        try:
-            resp = await self.session.request(method, str(url), headers=headers, timeout=self.timeout)
-        except Exception as e:
-            self.logger.error(e)
-            return
+def set_precision(precision):
+
+    ''' Parse numbers as 'float' (default) or 'decimal' '''
+
+    global number
+
+    if precision == 'decimal':
+        number = lambda value: Decimal(str(value))
+    else:
+        number = float
+
+class ExchangeError(Exception):
+
+    ''' A request to an exchange failed, its data is unknown (not empty) '''
+
+class Timeout(ExchangeError):
+
+    pass
+
+class Unavailable(ExchangeError):
+
+    ''' The circuit of the exchange is open, the request was not sent '''
+
+class BadResponse(ExchangeError):
+
+    ''' Connection error, HTTP 5xx, API error or undecodable body '''
+
+class ApiError(BadResponse):
+
+    ''' The exchange answered with an error payload, see Exchange.decode() '''
+
+class CircuitBreaker(object):
+
+    ''' Fail fast while an exchange keeps failing
+
+    After `threshold` failed requests in a row the circuit opens: requests
+    fail at once with Unavailable for `cooldown` seconds, then a single probe
+    is let through. Its success closes the circuit, its failure opens it for
+    another cooldown.
+    '''
+
+    def __init__(self, threshold=5, cooldown=30):
+
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.probing = False
+
+    def allow(self):
+
+        if self.opened is None:
+            return True
+
+        if not self.probing and time() - self.opened >= self.cooldown:
+            self.probing = True
+            return True
+
+        return False
+
+    def success(self):
+
+        self.failures = 0
+        self.opened = None
+        self.probing = False
+
+    def failure(self):
+
+        self.failures += 1
+        self.probing = False
+        if self.failures >= self.threshold:
+            self.opened = time()
+
+def get_breaker(exchange, **options):
+
+    ''' Return the CircuitBreaker shared by accounts of exchange '''
+
+    breaker = _breakers.get(exchange)
+
+    if breaker is None:
+        breaker = _breakers[exchange] = CircuitBreaker(**options)
+        metrics.CIRCUIT_OPEN.set_function(lambda: int(breaker.opened is not None), exchange=exchange)
+
+    return breaker
+
+def set_decoder(decoder='orjson', stream=False):
+
+    ''' Decode responses with 'orjson' when installed, otherwise 'json'
+
+    With stream the full tickers are read and decoded one item at a time
+    (stdlib decoder), keeping only the fields in use, see stream_json().
+    '''
+
+    global loads
+
+    if decoder == 'orjson' and orjson:
+        loads = orjson.loads
+    else:
+        loads = json.loads
+
+    globals()['stream'] = stream
+
+def set_offload(steps=(), workers=2):
+
+    ''' Run the named steps in a thread pool instead of on the event loop
+
+    Steps are 'decode' (responses), 'total' (calculate_total_balance) and
+    'render' (web pages). Threads share the GIL: the loop stays responsive
+    while they run, it does not get more CPU.
+    '''
+
+    global _executor
+
+    _offload.clear()
+    _offload.update(steps)
+
+    if _offload and _executor is None:
+        _executor = ThreadPoolExecutor(workers, thread_name_prefix='btc-offload')
+
+async def offload(step, function, *args):
+
+    ''' Return function(*args), in the thread pool if step is offloaded '''
+
+    if step not in _offload:
+        return function(*args)
+
+    return await asyncio.get_event_loop().run_in_executor(_executor, function, *args)
+
+def skip(buffer, pos, characters=WHITESPACE + ','):
+
+    while pos < len(buffer) and buffer[pos] in characters:
+        pos += 1
+
+    return pos
+
+async def stream_json(chunks, keep):
+
+    ''' Decode a JSON array or object read as byte chunks, item by item
+
+    keep(item), or keep((key, value)) for members of an object, returns
+    what to keep of it or None. Return the list of kept values. Only the
+    unparsed rest of the body and the current item are held in memory.
+    '''
+
+    decode = codecs.getincrementaldecoder('utf-8')().decode
+    buffer = ''
+    pos = 0
+    container = None
+    kept = []
+
+    async for chunk in chunks:
+        buffer = buffer[pos:] + decode(chunk)
+        pos = 0
+
+        while True:
+            pos = skip(buffer, pos)
+            if pos >= len(buffer):
+                break
+
+            if container is None:
+                container = buffer[pos]
+                if container not in '[{':
+                    raise ValueError('expected an array or an object')
+                pos += 1
+                continue
+
+            if buffer[pos] in ']}':
+                return kept
+
+            try:
+                if container == '{':
+                    key, end = _decoder.raw_decode(buffer, pos)
+                    end = skip(buffer, end, WHITESPACE)
+                    if end >= len(buffer):
+                        break
+                    if buffer[end] != ':':
+                        raise ValueError('expected : at {}'.format(end))
+                    value, end = _decoder.raw_decode(buffer, skip(buffer, end + 1, WHITESPACE))
+                    item = (key, value)
+                else:
+                    item, end = _decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # incomplete, wait for the next chunk
+                break
+
+            after = skip(buffer, end, WHITESPACE)
+            if after >= len(buffer) or (buffer[after] not in ',]}' and NUMBER.issuperset(buffer[after:])):
+                # a number or literal may go on in the next chunk, "1." or "1e" included
+                break
+            if buffer[after] not in ',]}':
+                raise ValueError('expected , at {}'.format(after))
+
+            pos = end
+            value = keep(item)
+            if value is not None:
+                kept.append(value)
+
+    raise ValueError('truncated JSON')
+
+class Balance(object):
+
+    __slots__ = ('currency', 'available', 'reserved')
+
+    def __init__(self, currency, available, reserved):
+
+        self.currency = currency
+        self.available = number(available)
+        self.reserved = number(reserved)
+
+    def __repr__(self):
+
+        return "Balance({}, {}, {})".format(self.currency, self.available, self.reserved)
+
+class Order(object):
+
+    ''' Open order or, as a fill, an order from history '''
+
+    __slots__ = ('id', 'symbol', 'side', 'quantity', 'price', 'status', 'updated')
+
+    def __init__(self, id, symbol, side, quantity, price, status='new', updated=None):
+
+        self.id = id
+        self.symbol = symbol
+        self.side = side
+        self.quantity = number(quantity)
+        self.price = number(price)
+        self.status = status
+        self.updated = updated
+
+    def __repr__(self):
+
+        return "Order({}, {}, {}, {} for {}, {})".format(self.id, self.symbol, self.side, self.quantity, self.price, self.status)
+
+def configure_sessions(**options):
+
+    ''' Override TCPConnector options used by sessions created afterwards '''
+
+    SESSION_OPTIONS.update(options)
+
+def get_session(proxy=None, loop=None):
+
+    ''' Return the shared session for proxy, creating it on first use
+
+    Plain and http proxied requests share one pooled session (pass proxy= per
+    request). socks proxies need their own aiosocks connector.
+    '''
+
+    key = proxy if proxy and proxy.startswith('socks') else None
+    session = _sessions.get(key)
+
+    if session is None or session.closed:
+        if key:
+            from aiosocks.connector import ProxyConnector, ProxyClientRequest
+            connector = ProxyConnector(loop=loop, **SESSION_OPTIONS)
+            session = ClientSession(connector=connector, request_class=ProxyClientRequest, loop=loop)
         else:
-            jresp = await resp.json(content_type=None)
-            resp.close()
+            connector = TCPConnector(loop=loop, **SESSION_OPTIONS)
+            session = ClientSession(connector=connector, loop=loop)
+        _sessions[key] = session
+
+    return session
+
+async def close_sessions():
+
+    for session in _sessions.values():
+        await session.close()
+
+    _sessions.clear()
+
+class RefreshPolicy(object):
+
+    ''' Fetch private endpoints only as often as they are likely to change
+
+    Prices are fetched every cycle. Orders and history are fetched every
+    cycle while the account is active (an open order flagged near the market
+    by the client's OrderMonitor or a fill in the last `recent` seconds),
+    otherwise their interval
+    grows by `step` up to `slow` seconds. A change in orders triggers a
+    history fetch, and balance is only fetched after orders or fills
+    changed, or every `slow` seconds.
+    '''
+
+    def __init__(self, step=30, slow=300, recent=600):
+
+        self.step = step
+        self.slow = slow
+        self.recent = recent
+        self.interval = {'orders': 0, 'history': 0}
+        self.fetched = {'orders': 0, 'history': 0, 'balance': 0}
+        # last good results, None until fetched once
+        self.balance = None
+        self.orders = None
+        self.last_fill = 0
+        self.dirty = True
+
+    def due(self, endpoint, now):
+
+        return now - self.fetched[endpoint] >= self.interval[endpoint]
+
+    def active(self, client, now):
+
+        return now - self.last_fill < self.recent or bool(client.monitor.near)
+
+    async def fetch(self, client):
+
+        ''' Return (balance, orders, history, prices) like get_data's gather '''
+
+        now = time()
+        history = None
+        jobs = {'prices': client.fetch_prices()}
+
+        if self.due('orders', now):
+            jobs['orders'] = client.get_orders()
+        if self.due('history', now):
+            jobs['history'] = client.get_history(cursor=client.history_cursor)
+
+        results = await client.gather(**jobs)
+        prices = results['prices']
 
-        if not jresp:
+        # a failed fetch keeps the last good orders and balance, retried next cycle
+        orders = results.get('orders')
+        if orders is not None:
+            self.fetched['orders'] = now
+            if self.orders is None or {(o.id, o.quantity) for o in orders} != {(o.id, o.quantity) for o in self.orders}:
+                self.dirty = True
+                if 'history' not in results:
+                    results.update(await client.gather(history=client.get_history(cursor=client.history_cursor)))
+            self.orders = orders
+
+        if 'history' in results:
+            history = results['history']
+            if history is not None:
+                self.fetched['history'] = now
+                # the first fetch has no cursor and only loads past fills
+                if client.history_cursor and any(order.updated and order.updated > client.history_cursor for order in history):
+                    self.last_fill = now
+                    self.dirty = True
+
+        if self.dirty or now - self.fetched['balance'] >= self.slow:
+            balance = (await client.gather(balance=client.get_balance()))['balance']
+            if balance is not None:
+                self.balance = balance
+                self.fetched['balance'] = now
+                self.dirty = False
+
+        client.monitor.set_orders(self.orders)
+        client.monitor.update(prices or {})
+
+        for endpoint in self.interval:
+            if self.active(client, now):
+                self.interval[endpoint] = 0
+            else:
+                self.interval[endpoint] = min(self.interval[endpoint] + self.step, self.slow)
+
+        return self.balance, self.orders, history, prices
+
+def register(name, module):
+
+    ''' Make adapter class `name` of `module` available to get_adapter() '''
+
+    ADAPTERS[name] = module
+
+def get_adapter(name):
+
+    ''' Return adapter class `name`, importing only its module '''
+
+    module = ADAPTERS.get(name)
+
+    if module is None:
+        from importlib.metadata import entry_points
+        for entry_point in entry_points(group=ENTRY_POINTS):
+            if entry_point.name == name:
+                return entry_point.load()
+        raise KeyError('unknown exchange {}'.format(name))
+
+    return getattr(importlib.import_module(module), name)
+
+def __getattr__(name):
+
+    # from clients import HitBTC still works, loading the adapter lazily
+    if name in ADAPTERS:
+        return get_adapter(name)
+
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
+
+class OrderMonitor(object):
+
+    ''' Open orders indexed by symbol and side, flagged when near the market
+
+    Buy and sell prices of each symbol are kept sorted, so the orders within
+    `band` (a fraction of the market price) are a bisection away. A price
+    update only revisits the symbols with orders whose price changed.
+    '''
+
+    def __init__(self, band=0.02):
+
+        self.band = band
+        self.orders = None
+        # symbol: {side: [(price, position in self.orders)]}
+        self.index = {}
+        self.market = {}
+        # symbol: [(order, market price, distance)]
+        self.near = {}
+
+    def set_orders(self, orders):
+
+        ''' Reindex after orders changed, None keeps the current ones '''
+
+        if orders is None or orders is self.orders:
             return
 
-        if url.path.endswith('json'):
-            return jresp
+        self.orders = orders
+        self.index = {}
+        self.market = {}
+        self.near = {}
 
-        if jresp.get('success'):
-            return jresp.get('result')
-        else:
-            self.logger.error(jresp.get('message'))
+        for position, order in enumerate(orders):
+            sides = self.index.setdefault(order.symbol, {'buy': [], 'sell': []})
+            sides['buy' if order.side == 'buy' else 'sell'].append((float(order.price), position))
 
-    async def close(self):
+        for sides in self.index.values():
+            for side in sides.values():
+                side.sort()
 
-        await self.session.close()
+    def update(self, prices):
 
-    def __getattr__(self, attr, *args, **kwargs):
+        for symbol, sides in self.index.items():
+            market = prices.get(symbol)
+            if not market or market == self.market.get(symbol):
+                continue
 
-        self.logger.error("method {}({}, {}) doesn't exist".format(attr, args, kwargs))
+            self.market[symbol] = market
+            market = float(market)
 
-    async def get_data(self, callback=None):
+            # a buy fills when the market falls to it, a sell when it rises
+            buys = sides['buy'][bisect_left(sides['buy'], (market * (1 - self.band),)):]
+            sells = sides['sell'][:bisect_right(sides['sell'], (market * (1 + self.band), len(self.orders)))]
 
-        '''data = {
-            'balance': dict,
-            'orders': list,
-            'history': list,
-            'prices': dict,
-            'total': str,
-        }'''
+            near = [
+                (self.orders[position], market, abs(market - price) / market)
+                for price, position in buys + sells
+            ]
+            if near:
+                self.near[symbol] = near
+            else:
+                self.near.pop(symbol, None)
 
-        futures = (
-            asyncio.ensure_future(self.get_balance()),
-            asyncio.ensure_future(self.get_orders()),
-            asyncio.ensure_future(self.get_history()),
-            asyncio.ensure_future(self.get_prices()),
-        )
+    def near_orders(self):
 
-        results = await asyncio.gather(*futures)
+        ''' Return [(order, market price, distance)], nearest first '''
 
-        data = {}
+        return sorted((item for items in self.near.values() for item in items), key=lambda item: item[2])
 
-        data['balance'] = results[0]
-        data['orders'] = results[1]
-        data['history'] = results[2]
-        data['prices'] = results[3]
+class PublicCache(object):
 
-        total = self.calculate_total_balance(balance=data.get('balance'), prices=data.get('prices'))
+    ''' Results of public requests shared by all callers, per key
 
-        data['total'] = total
+    get(key, fetch) returns the value fetched less than `ttl` seconds ago,
+    otherwise concurrent callers wait for a single fetch(). A value up to
+    `stale` seconds past its ttl is returned at once while one fetch in the
+    background revalidates it. Empty results and errors are not cached.
+    '''
 
-        if callback:
-            callback(data)
-        else:
-            return data
+    def __init__(self, ttl=0, stale=0):
 
-    async def get_balance(self):
+        self.ttl = ttl
+        self.stale = stale
+        # key: (value, time fetched)
+        self.entries = {}
+        self.pending = {}
 
-        ''' Return non-zero balance '''
+    async def get(self, key, fetch):
 
-        ret = {}
+        entry = self.entries.get(key)
 
-        balances = await self.get_response(
-            url="{}/api.html".format(self.api_url),
-            params={'a': 'getbalances'},
-            auth=True
-        )
+        if entry:
+            value, fetched = entry
+            age = time() - fetched
+            if age < self.ttl:
+                return value
+            if age < self.ttl + self.stale:
+                self.refresh(key, fetch)
+                return value
 
-        if balances:
-            for balance in balances:
-                currency = balance['Currency']
-                if float(balance['Available']) > 0 or float(balance['Balance']) > 0:
-                    ret[currency] = {'available': balance['Available'], 'reserved': balance['Balance']}
+        return await asyncio.shield(self.refresh(key, fetch))
 
-        return ret
+    def refresh(self, key, fetch):
 
-    async def get_orders(self):
+        future = self.pending.get(key)
 
-        ''' Return active orders '''
+        if future is None:
+            future = self.pending[key] = asyncio.ensure_future(self.run(key, fetch))
+            # nobody waits for a revalidation, mark its error as retrieved
+            future.add_done_callback(lambda future: future.cancelled() or future.exception())
 
-        ret = []
+        return future
 
-        orders = await self.get_response(
-            url="{}/api.html".format(self.api_url),
-            params={'a': 'getopenorders'},
-            auth=True
-        )
+    async def run(self, key, fetch):
 
-        if orders:
-            for x in orders:
-                order = {}
-                order['symbol'] = x['Exchange']
-                order['side'] = 'buy' if x['OrderType'] == 'LIMIT_BUY' else 'sell'
-                order['quantity'] = "{:.2f}".format(x['Quantity'])
-                order['price'] = "{:.9f}".format(x['Limit']).rstrip('0')
-                order['id'] = x['OrderUuid']
-                ret.append(order)
+        try:
+            value = await fetch()
+        finally:
+            del self.pending[key]
 
-        return ret
+        if value:
+            self.entries[key] = (value, time())
 
-    async def get_history(self, count=20):
+        return value
 
-        ''' Return order history '''
+class Ticker(object):
 
-        ret = []
+    ''' Prices of one exchange shared by all its accounts
 
-        trade = await self.get_response(
-            url="{}/api.html".format(self.api_url),
-            params={'a': 'getorderhistory', 'count': count},
-            auth=True,
-        )
+    The owner fetches them through a PublicCache, so at most once per `ttl`
+    seconds however many accounts ask, serving them up to `stale` seconds
+    late while refreshing. Tickers of other processes are not owners and get
+    the prices with update().
 
-        if trade:
-            for x in trade:
-                order = {}
-                order['symbol'] = x['Exchange']
-                order['quantity'] = "{:.2f}".format(x['Quantity'])
-                order['price'] = "{:.9f}".format(x['PricePerUnit']).rstrip('0')
-                order['id'] = x['OrderUuid']
-                order['side'] = 'buy'
-                if x['OrderType'] == 'LIMIT_BUY':
-                    order['side'] = 'buy'
-                    order['quantity'] = "{:.2f}".format(x['Quantity']/x['PricePerUnit'])
-                else:
-                    order['side'] = 'sell'
-                if x['QuantityRemaining'] == 0:
-                    order['status'] = 'filled'
-                else:
-                    order['status'] = 'other'
-                order['updatedAt'] = x['TimeStamp']
-                ret.append(order)
+    With `full` set only the symbols the accounts want (see want()) are
+    fetched and merged into the last full feed, which is refreshed every
+    `full` seconds or when more symbols are wanted than the adapter's
+    MAX_SUBSET. fresh() tells which prices of the merged dict were fetched.
+    '''
 
-        return ret
+    def __init__(self, ttl=0, owner=True, full=None, stale=0):
 
-    async def get_prices(self):
+        self.cache = PublicCache(ttl, stale)
+        self.owner = owner
+        self.full = full
+        self.prices = {}
+        self.fetched = 0
+        self.full_fetched = 0
+        # account (or 'alerts'): symbols
+        self.wanted = {}
+        # prices fetched last, merged into self.prices, None after a full feed
+        self.subset = None
 
-        ''' Return prices '''
+    def update(self, prices):
 
-        ret = {}
+        self.prices = prices
+        self.fetched = time()
 
-        prices = await self.get_response(url="{}/prices.json".format(self.api_url))
+    def merge(self, subset):
 
-        if prices:
-            for symbol, values in prices.items():
-                price = values.get('lastprice')
-                if price:
-                    ret[symbol] = "{:.9f}".format(price).rstrip('0')
+        ''' Merge subset into a copy of the prices, return the copy '''
 
-        return ret
+        prices = dict(self.prices)
+        prices.update(subset)
+        self.update(prices)
+        self.subset = subset
 
-    def calculate_total_balance(self, balance, prices, base='BTC'):
+        return prices
 
-        ''' Calculate total balance in base currency '''
+    async def get(self, client):
 
-        total = 0
+        if not self.owner:
+            return self.prices
 
-        if prices and balance:
+        return await self.cache.get('prices', lambda: self.fetch(client))
 
-            for currency, values in balance.items():
+    def want(self, account, symbols):
 
-                available = float(values['available'])
-                reserved = float(values['reserved'])
+        self.wanted[account] = symbols
 
-                if currency == base:
-                    last = 1
-                    available = 0
-                else:
-                    pair = currency + '-' + base
-                    last = float(prices.get(pair, 0))
+    def fresh(self, prices):
 
-                total += (available + reserved)*last
+        ''' Return the prices of dict prices fetched by its request '''
 
-        return total
+        if self.subset is not None and prices is self.prices:
+            return self.subset
+
+        return prices
+
+    async def fetch(self, client):
 
-class HitBTC(object):
+        now = time()
 
-    ''' Connect to exchange, get some stuff '''
+        if self.full and self.prices and now - self.full_fetched < self.full:
+            # only symbols the exchange lists, as of the last full feed
+            symbols = {symbol for symbols in self.wanted.values() for symbol in symbols if symbol in self.prices}
+            if not symbols:
+                # nothing wanted: get_prices(set()) would be the full feed
+                self.subset = {}
+                return self.prices
+            if len(symbols) <= client.MAX_SUBSET:
+                subset = await client.get_prices(symbols)
+                if not subset:
+                    return subset
+                return self.merge(subset)
+
+        prices = await client.get_prices()
+        if prices:
+            self.full_fetched = now
+            self.update(prices)
+            self.subset = None
+
+        return prices
+
+def get_ticker(exchange, ttl=0, full=None, stale=0):
+
+    ''' Return the Ticker shared by accounts of exchange in this process '''
+
+    ticker = _tickers.get(exchange)
+
+    if ticker is None:
+        ticker = _tickers[exchange] = Ticker(ttl, full=full, stale=stale)
+
+    return ticker
+
+class Exchange(object):
+
+    ''' Base of exchange adapters
+
+    Subclasses implement get_balance, get_orders, get_history(cursor=),
+    get_prices(symbols=None) and symbol(), and may serve a push feed from
+    get_live_data(). get_data() fetches the four concurrently (or as
+    RefreshPolicy decides) and normalizes the results.
+
+    Requests go through request(), which raises ExchangeError instead of
+    returning nothing. A phase that raised, or exceeded its deadline, is
+    None in get_data() so the last good data is kept.
+    '''
+
+    # most symbols get_prices(symbols) fetches more cheaply than the full feed
+    MAX_SUBSET = 200
 
     def __init__(
         self,
-        url="https://hitbtc.com",
-        api_url="https://api.hitbtc.com",
+        url=None,
+        api_url=None,
         login=None,
         password=None,
         timeout=5,
         loop=None,
         log=None,
+        proxy=None,
+        adaptive=None,
+        name=None,
+        ticker=None,
+        near_band=0.02,
+        bases=(),
+        deadlines=None,
+        hedge=None,
+        breaker=None,
     ):
 
         self.url = url
-        self.api_url = api_url + "/api/2"
-        self.name = self.__class__.__name__
+        self.api_url = api_url
+        self.login = login
+        self.password = password
+        # account name, the adapter's name for the main account
+        self.exchange = self.__class__.__name__
+        self.name = name or self.exchange
+        self.ticker = ticker or Ticker()
+        # currencies the valuation converts to, see wanted_symbols()
+        self.bases = bases
         self.logger = logging.getLogger(self.name)
         if log:
             self.logger.setLevel(log)
@@ -293,14 +748,18 @@ class HitBTC(object):
 
         self.loop = loop
 
-        auth = BasicAuth(login=login, password=password)
-
-        try:
-            self.session = ClientSession(loop=self.loop, auth=auth)
-        except Exception as e:
-            print(e)
-
+        self.proxy = proxy
+        self.session = get_session(proxy, loop=self.loop)
         self.timeout = timeout
+        # phase: seconds, see timed()
+        self.deadlines = deadlines or {}
+        # seconds before a hedged GET is sent again, see request()
+        self.hedge = hedge
+        self.breaker = get_breaker(self.exchange, **(breaker or {}))
+        # updated time of the newest known fill, see get_history()
+        self.history_cursor = None
+        self.policy = RefreshPolicy(**adaptive) if adaptive is not None else None
+        self.monitor = OrderMonitor(near_band)
 
     def __getattr__(self, attr, *args, **kwargs):
 
@@ -308,194 +767,284 @@ class HitBTC(object):
 
     async def close(self):
 
-        await self.session.close()
+        ''' Nothing to release, the session is shared (see close_sessions) '''
 
     async def get_data(self, callback=None):
 
         '''data = {
-            'balance': dict,
-            'orders': list,
-            'history': list,
-            'prices': dict,
-            'total': str,
+            'balance': {currency: Balance},
+            'orders': [Order],
+            'history': [Order],
+            'prices': {symbol: number},
+            'total': number,
+            'cursor': str,
+            'exchange': str,
+            'near': [(Order, market price, distance)],
         }'''
 
-        futures = (
-            asyncio.ensure_future(self.get_balance()),
-            asyncio.ensure_future(self.get_orders()),
-            asyncio.ensure_future(self.get_history()),
-            asyncio.ensure_future(self.get_prices()),
-        )
+        data = self.get_live_data()
+
+        if data is None:
+            if self.policy:
+                results = await self.policy.fetch(self)
+            else:
+                results = await self.gather(
+                    balance=self.get_balance(),
+                    orders=self.get_orders(),
+                    history=self.get_history(cursor=self.history_cursor),
+                    prices=self.fetch_prices(),
+                )
+                results = (results['balance'], results['orders'], results['history'], results['prices'])
+            data = self.normalize(*results)
+
+        with metrics.PHASE_SECONDS.time(exchange=self.name, phase='total'):
+            if data['balance'] is None or not data['prices']:
+                data['total'] = None
+            else:
+                data['total'] = await offload('total', self.calculate_total_balance, data['balance'], data['prices'])
 
-        results = await asyncio.gather(*futures)
+        if callback:
+            callback(data)
+        else:
+            return data
 
-        data = {}
+    def fetch_prices(self):
 
-        data['balance'] = results[0]
-        data['orders'] = results[1]
-        data['history'] = results[2]
-        data['prices'] = results[3]
+        ''' Return get_prices(), shared with other accounts through the ticker '''
 
-        total = self.calculate_total_balance(balance=data.get('balance'), prices=data.get('prices'))
+        return self.ticker.get(self)
 
-        data['total'] = total
+    def public(self, key, fetch):
 
-        if callback:
-            callback(data)
-        else:
-            return data
+        ''' Return await fetch() through the cache shared by the exchange '''
 
-    async def get_response(
-        self,
-        method='GET',
-        url=None,
-        params={},
-    ):
+        return self.ticker.cache.get(key, fetch)
 
-        ''' Get response '''
+    def wanted_symbols(self, balance, orders, base='BTC'):
 
-        try:
-            resp = await self.session.request(method, url, params=params, timeout=self.timeout)
-        except Exception as e:
-            self.logger.error(e)
-            return
+        ''' Return symbols of open orders and pairs pricing held currencies '''
 
-        try:
-            jresp = await resp.json(content_type=None)
-            resp.close()
-        except Exception as e:
-            self.logger.error(e)
-            return
+        symbols = {order.symbol for order in orders or ()}
 
-        if 'error' in jresp:
-            self.logger.error(jresp)
-        else:
-            return jresp
+        for currency in list(balance or ()) + list(self.bases):
+            if currency != base:
+                symbols.add(self.symbol(currency, base))
+                symbols.add(self.symbol(base, currency))
 
-    async def get_balance(self):
+        return symbols
 
-        ''' Return currency list with positive available or reserved balance '''
+    def get_live_data(self):
 
-        self.logger.info('get balance')
+        ''' Return data from a push feed, None to fetch it over REST '''
 
-        url = "{}/trading/balance".format(self.api_url)
+    def normalize(self, balance, orders, history, prices):
 
-        balances = await self.get_response(url=url)
+        ''' Build get_data()'s dict but the total, None for what failed to be fetched '''
 
-        ret = {}
+        data = {}
 
-        if balances:
-            for balance in balances:
-                currency = balance['currency']
+        data['exchange'] = self.exchange
+        data['balance'] = balance
+        data['orders'] = orders
+        data['history'] = history or []
+        data['prices'] = prices
+        # the part of prices just fetched, the rest may be older, see Ticker
+        data['fresh'] = self.ticker.fresh(prices)
+        data['cursor'] = self.next_cursor(history)
 
-                if float(balance['available']) > 0 or float(balance['reserved']) > 0:
-                    ret[currency] = balance
+        self.monitor.set_orders(orders)
+        self.monitor.update(prices or {})
+        data['near'] = self.monitor.near_orders()
 
-        return ret
+        if balance or orders:
+            self.ticker.want(self.name, self.wanted_symbols(balance, orders))
 
-    async def get_orders(self):
+        return data
 
-        ''' Return active orders for exchange '''
+    def next_cursor(self, history):
 
-        self.logger.info('get orders')
+        ''' Return the cursor after history, the current one if it failed '''
 
-        url = "{}/order".format(self.api_url)
+        if history is None:
+            return self.history_cursor
 
-        orders = await self.get_response(url=url)
+        updated = [order.updated for order in history if order.updated]
+        if self.history_cursor:
+            updated.append(self.history_cursor)
 
-        if orders:
-            return orders
-        else:
-            return []
+        return max(updated, default=None)
 
-    async def get_order(self, order_id):
+    async def read_items(self, resp, endpoint, keep):
 
-        ''' Return order by order id '''
+        ''' Return what keep() keeps of the items of resp, see stream_json() '''
 
-        self.logger.info('get order {}'.format(order_id))
+        size = 0
 
-        url = "{}/order/{}".format(self.api_url, order_id)
+        async def chunks():
+            nonlocal size
+            async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                size += len(chunk)
+                yield chunk
 
-        order = await self.get_response(url=url)
+        body = chunks()
+        try:
+            return await stream_json(body, keep)
+        finally:
+            await body.aclose()
+            metrics.HTTP_BYTES.inc(size, exchange=self.name, endpoint=endpoint)
 
-        return order
+    async def timed(self, phase, coroutine):
 
-    async def get_history(self, limit=20):
+        deadline = self.deadlines.get(phase)
 
-        ''' Return filled orders for exchange '''
+        with metrics.PHASE_SECONDS.time(exchange=self.name, phase=phase):
+            if not deadline:
+                return await coroutine
+            try:
+                return await asyncio.wait_for(coroutine, deadline)
+            except asyncio.TimeoutError:
+                raise Timeout('{} exceeded its {}s deadline'.format(phase, deadline))
 
-        self.logger.info('get history')
+    async def gather(self, **phases):
 
-        url = "{}/history/order".format(self.api_url)
-        params={'sort': 'desc', 'limit': limit}
+        ''' Run phase coroutines concurrently, return {phase: result or None} '''
 
-        history_trades = await self.get_response(url=url, params=params)
+        results = await asyncio.gather(
+            *(self.timed(phase, coroutine) for phase, coroutine in phases.items()),
+            return_exceptions=True
+        )
 
-        if history_trades:
-            return history_trades
-        else:
-            return []
+        ret = {}
+        for phase, result in zip(phases, results):
+            if isinstance(result, Exception):
+                self.logger.error('{}: {!r}'.format(phase, result))
+                result = None
+            ret[phase] = result
 
-    async def get_prices(self):
+        return ret
 
-        ''' Return prices '''
+    async def request(self, method, url, endpoint, keep=None, hedge=False, signed=False, **kwargs):
 
-        self.logger.info('get prices')
+        ''' Return the decode()d body, or what keep() kept of a 200 body
 
-        url = "{}/public/ticker/".format(self.api_url)
+        Raise Unavailable while the exchange's circuit is open, Timeout or
+        BadResponse (connection error, HTTP 5xx, error from decode()). All
+        but errors of the request itself count as failures of the exchange
+        for the circuit breaker, so does a request cancelled by a deadline.
+        Errors of the request are HTTP 4xx but 408 and 429, and for signed
+        requests ApiError (bad key, nonce): they are the account's. With
+        hedge and a `hedge` delay configured a request without answer after
+        that delay is sent once more and the first answer wins: only for
+        idempotent requests.
+        '''
 
-        tickers = await self.get_response(url=url)
+        if not self.breaker.allow():
+            metrics.HTTP_REQUESTS.inc(exchange=self.name, endpoint=endpoint, status='open')
+            raise Unavailable('{} circuit open'.format(self.exchange))
 
-        prices = {}
+        start = perf_counter()
+        status = 'error'
+        # settled in finally: a cancelled probe must not leave the circuit open
+        healthy = False
 
-        if tickers:
+        try:
+            try:
+                if hedge and self.hedge:
+                    status, body = await self.hedged(method, url, endpoint, keep, **kwargs)
+                else:
+                    status, body = await self.send(method, url, endpoint, keep, **kwargs)
+            except asyncio.TimeoutError:
+                status = 'timeout'
+                raise Timeout('{} timed out'.format(endpoint))
+            except Exception as e:
+                raise BadResponse('{}: {!r}'.format(endpoint, e))
+            finally:
+                metrics.HTTP_SECONDS.observe(perf_counter() - start, exchange=self.name, endpoint=endpoint)
+                metrics.HTTP_REQUESTS.inc(exchange=self.name, endpoint=endpoint, status=str(status))
+
+            if status >= 500:
+                raise BadResponse('{}: HTTP {}'.format(endpoint, status))
+
+            # a 4xx is an error of the request, the exchange did answer
+            healthy = 400 <= status < 500 and status not in OVERLOADED
+            if not (keep and status == 200):
+                try:
+                    body = await offload('decode', self.decode, endpoint, status, body)
+                except ApiError:
+                    healthy = healthy or (signed and status < 400)
+                    raise
+            healthy = True
+
+            return body
+        finally:
+            if healthy:
+                self.breaker.success()
+            else:
+                self.breaker.failure()
+
+    def decode(self, endpoint, status, body):
+
+        ''' Return the payload of body, raise BadResponse for API errors '''
 
-            for ticker in tickers:
-                last = ticker.get('last')
-                symbol = ticker.get('symbol')
+        try:
+            return loads(body)
+        except Exception as e:
+            raise BadResponse('{}: HTTP {}, {!r}'.format(endpoint, status, e))
 
-                if symbol and last:
-                    prices[symbol] = last
+    async def send(self, method, url, endpoint, keep, **kwargs):
 
-        return prices
+        resp = await self.session.request(method, url, timeout=self.timeout, proxy=self.proxy, **kwargs)
 
-    async def new_order(self, symbol, side, quantity, price):
+        try:
+            if keep and resp.status == 200:
+                body = await self.read_items(resp, endpoint, keep)
+            else:
+                body = await resp.read()
+                metrics.HTTP_BYTES.inc(len(body), exchange=self.name, endpoint=endpoint)
+        finally:
+            resp.close()
+
+        return resp.status, body
 
-        self.logger.info('place new order in {}'.format(symbol))
+    async def hedged(self, *args, **kwargs):
 
-        order_id = uuid.uuid4().hex
+        tasks = {asyncio.ensure_future(self.send(*args, **kwargs))}
+        done, pending = await asyncio.wait(tasks, timeout=self.hedge)
 
-        params = {
-            'symbol': symbol,
-            'side': side,
-            'quantity': quantity,
-            'price': price,
-        }
+        if not done:
+            metrics.HTTP_HEDGED.inc(exchange=self.name, endpoint=args[2])
+            tasks.add(asyncio.ensure_future(self.send(*args, **kwargs)))
+
+        try:
+            while True:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                answered = [task for task in done if not task.exception()]
+                # the first answer wins, the last failure is raised
+                if answered or not tasks:
+                    return (answered or list(done))[0].result()
+        finally:
+            for task in tasks:
+                task.cancel()
 
-        url = "{}/order/{}".format(self.api_url, order_id)
+    def symbol(self, currency, base):
 
-        response = await self.get_response(method='PUT', url=url, params=params)
+        ''' Return the ticker symbol of currency priced in base '''
 
-        return response
+        return currency + base
 
     def calculate_total_balance(self, balance=None, prices=None, base='BTC'):
 
         ''' Calculate total balance in base currency '''
 
-        self.logger.info('set total balance in {}'.format(base))
-
         total = 0
 
         if prices and balance:
             for currency, values in balance.items():
-                available = float(values['available'])
-                reserved = float(values['reserved'])
-
                 if currency == base:
                     last = 1
                 else:
-                    last = float(prices.get(currency+base, 0))
+                    last = prices.get(self.symbol(currency, base), 0)
 
-                total += (available + reserved)*last
+                total += (values.available + values.reserved)*last
 
-        return "{:.9f}".format(total)
+        return total
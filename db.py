@@ -1,24 +1,100 @@
+import asyncio
 import aiosqlite
+import metrics
 
 DB = 'btc.db'
 
+PRAGMAS = (
+    'pragma journal_mode = wal;',
+    'pragma synchronous = normal;',
+    'pragma temp_store = memory;',
+    'pragma cache_size = -8000;',
+    'pragma busy_timeout = 5000;',
+)
+
+TABLES = {
+    # table: (key columns, columns)
+    'prices': (('exchange', 'symbol'), ('exchange', 'symbol', 'price')),
+    'orders': (('id', 'exchange'), ('id', 'exchange', 'symbol', 'side', 'quantity', 'price')),
+}
+
+_conn = None
+_lock = asyncio.Lock()
+_snapshots = {}
+# (table, name): lock held from reading the snapshot to replacing it
+_sync_locks = {}
+_listeners = []
+
+async def connect():
+
+    ''' Return the shared connection, opening it on first use '''
+
+    global _conn
+
+    if _conn is None:
+        _conn = await aiosqlite.connect(DB)
+        for pragma in PRAGMAS:
+            await _conn.execute(pragma)
+
+    return _conn
+
+async def close():
+
+    global _conn
+
+    if _conn is not None:
+        await _conn.close()
+        _conn = None
+
+    _snapshots.clear()
+    _sync_locks.clear()
+
+async def write(*statements, table='other'):
+
+    ''' Run (command, rows) pairs with executemany in a single transaction '''
+
+    async with _lock:
+        conn = await connect()
+        try:
+            with metrics.DB_WRITE_SECONDS.time(table=table):
+                for command, rows in statements:
+                    await conn.executemany(command, rows)
+                await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+
+    metrics.DB_ROWS.inc(sum(len(rows) for command, rows in statements), table=table)
+
 async def init_db():
 
-    async with aiosqlite.connect(DB) as db:
-        await db.execute("create table if not exists history (id integer, exchange varchar(10), symbol varchar(10), side varchar(5), price float, quantity real, confirmed tinyint default 0, PRIMARY KEY (id, exchange));")
-        await db.execute("create table if not exists orders (id integer, exchange varchar(10), symbol varchar(10), side varchar(5), price float, quantity real);")
-        await db.execute("create table if not exists prices (exchange varchar(10), symbol varchar(10), price float);")
-        await db.execute("create table if not exists total (date datetime, exchange varchar(10), total float);")
-        await db.commit()
+    async with _lock:
+        conn = await connect()
+        await conn.execute("create table if not exists history (id integer, exchange varchar(10), symbol varchar(10), side varchar(5), price float, quantity real, confirmed tinyint default 0, PRIMARY KEY (id, exchange));")
+        await conn.execute("create table if not exists orders (id integer, exchange varchar(10), symbol varchar(10), side varchar(5), price float, quantity real);")
+        await conn.execute("create table if not exists prices (exchange varchar(10), symbol varchar(10), price float);")
+        await conn.execute("create table if not exists total (date datetime, exchange varchar(10), total float);")
+        await conn.execute("create table if not exists cursors (exchange varchar(10) primary key, position varchar(32));")
+        await conn.execute("create table if not exists alerts (id integer primary key autoincrement, exchange varchar(10), symbol varchar(10), kind varchar(8), value float, window integer default 0, active tinyint default 1, created datetime, triggered datetime);")
+        for table, (keys, columns) in TABLES.items():
+            await conn.execute("delete from {0} where rowid not in (select min(rowid) from {0} group by {1});".format(table, ', '.join(keys)))
+            await conn.execute("create unique index if not exists {0}_key on {0} ({1});".format(table, ', '.join(keys)))
+        await conn.commit()
 
-async def exec_select(command):
+async def exec_select(command, params=()):
 
-    async with aiosqlite.connect(DB) as db:
-        async with db.execute(command) as cursor:
-            values = await cursor.fetchall()
-            return values
+    conn = await connect()
+    async with conn.execute(command, params) as cursor:
+        values = await cursor.fetchall()
+        return values
 
-async def get_history():
+async def get_history(limit=None):
+
+    ''' Return fills in insertion order, the last `limit` ones if given '''
+
+    if limit:
+        rows = await exec_select("select * from history order by rowid desc limit ?;", (limit,))
+        return rows[::-1]
 
     return await exec_select("select * from history;")
 
@@ -30,71 +106,230 @@ async def get_prices():
 
     return await exec_select("select * from prices;")
 
-async def get_history_confirmed():
+async def get_history_confirmed(exchange=None):
+
+    if exchange:
+        return await exec_select("select * from history where confirmed < 1 and exchange = ?;", (exchange,))
 
     return await exec_select("select * from history where confirmed < 1;")
 
 async def set_history_confirmed(order_id, exchange):
 
-    await db.execute('update history set confirmed = 1 where id = ? and exchange = ?;', (order_id, exchange))
-    await db.commit()
+    await set_history_confirmed_many([(order_id, exchange)])
+
+async def set_history_confirmed_many(keys):
+
+    ''' Mark (id, exchange) rows confirmed in one transaction, publishing them as updated '''
+
+    if not keys:
+        return
+
+    await write(('update history set confirmed = 1 where id = ? and exchange = ?;', keys), table='history')
+
+    updated = {}
+    # a pair of parameters per key, within SQLite's limit of 999
+    for i in range(0, len(keys), 400):
+        chunk = keys[i:i + 400]
+        rows = await exec_select(
+            "select * from history where (id, exchange) in (values {});".format(', '.join(['(?, ?)'] * len(chunk))),
+            [value for key in chunk for value in key],
+        )
+        for row in rows:
+            updated.setdefault(row[1], {})[(row[0], row[1])] = row
+
+    for name, rows in updated.items():
+        changes = {'inserted': {}, 'updated': rows, 'removed': []}
+        for callback in list(_listeners):
+            callback('history', name, changes)
+
+async def get_cursor(name):
+
+    rows = await exec_select("select position from cursors where exchange = ?;", (name,))
+
+    if rows:
+        return rows[0][0]
+
+async def set_cursor(name, position):
+
+    if _snapshots.get(('cursors', name)) == position:
+        return
+
+    await write(('insert or replace into cursors (exchange, position) values (?, ?);', [(name, position)]), table='cursors')
+
+    _snapshots[('cursors', name)] = position
+
+async def get_alerts(active=False):
+
+    if active:
+        return await exec_select("select * from alerts where active = 1;")
+
+    return await exec_select("select * from alerts;")
+
+async def add_alert(exchange, symbol, kind, value, window=0):
+
+    ''' Insert an alert, return its row '''
+
+    async with _lock:
+        conn = await connect()
+        cursor = await conn.execute(
+            "insert into alerts (exchange, symbol, kind, value, window, created) values (?, ?, ?, ?, ?, datetime('now'));",
+            (exchange, symbol, kind, value, window),
+        )
+        await conn.commit()
+
+    rows = await exec_select("select * from alerts where id = ?;", (cursor.lastrowid,))
+
+    return rows[0]
 
-async def set_total(name, total):
+async def remove_alert(alert_id):
 
-    async with aiosqlite.connect(DB) as db:
-        values = (name, total)
-        await db.execute('insert into total (exchange, total, date) values (?, ?, NOW())', values)
-        await db.commit()
+    await write(('delete from alerts where id = ?;', [(alert_id,)]), table='alerts')
+
+async def set_alerts_triggered(ids):
+
+    if ids:
+        await write(("update alerts set active = 0, triggered = datetime('now') where id = ?;", [(i,) for i in ids]), table='alerts')
 
 async def set_history(name, orders):
 
-    async with aiosqlite.connect(DB) as db:
-        for order in orders:
-            if order.get('id') and order['status'] == 'filled':
-                values = (
-                    order['id'],
-                    name,
-                    order['symbol'],
-                    order['side'],
-                    float(order['price']),
-                    order['quantity'],
-                    0,
-                )
-                await db.execute('insert or ignore into history (id, exchange, symbol, side, price, quantity, confirmed) values (?, ?, ?, ?, ?, ?, ?);', values)
-
-        await db.commit()
+    ''' Insert filled orders not seen before, publishing them as inserted '''
+
+    if ('history', name) not in _snapshots:
+        rows = await exec_select("select id from history where exchange = ?;", (name,))
+        _snapshots[('history', name)] = {row[0] for row in rows}
+
+    known = _snapshots[('history', name)]
+
+    rows = {}
+    for order in orders:
+        if order.id and order.status == 'filled' and order.id not in known:
+            rows[(order.id, name)] = (
+                order.id,
+                name,
+                order.symbol,
+                order.side,
+                float(order.price),
+                float(order.quantity),
+                0,
+            )
+
+    if not rows:
+        return
+
+    await write(('insert or ignore into history (id, exchange, symbol, side, price, quantity, confirmed) values (?, ?, ?, ?, ?, ?, ?);', list(rows.values())), table='history')
+
+    known.update(key[0] for key in rows)
+
+    changes = {'inserted': rows, 'updated': {}, 'removed': []}
+
+    for callback in list(_listeners):
+        callback('history', name, changes)
+
+    return changes
+
+def subscribe(callback):
+
+    ''' Call callback(table, exchange, changes) after every synced change '''
+
+    _listeners.append(callback)
+
+def unsubscribe(callback):
+
+    if callback in _listeners:
+        _listeners.remove(callback)
+
+async def get_snapshot(table, name):
+
+    ''' Return the last written rows of exchange as {key: row} '''
+
+    if (table, name) not in _snapshots:
+        keys, columns = TABLES[table]
+        index = [columns.index(column) for column in keys]
+        rows = await exec_select("select {} from {} where exchange = ?;".format(', '.join(columns), table), (name,))
+        _snapshots[(table, name)] = {tuple(row[i] for i in index): tuple(row) for row in rows}
+
+    return _snapshots[(table, name)]
+
+async def sync(table, name, rows):
+
+    ''' Write only the difference between rows and the last snapshot
+
+    rows is {key: row} with keys and rows ordered as in TABLES. Return the
+    change set {'inserted': {key: row}, 'updated': {key: row}, 'removed': [key]}.
+    '''
+
+    lock = _sync_locks.setdefault((table, name), asyncio.Lock())
+
+    async with lock:
+        return await _sync(table, name, rows)
+
+async def _sync(table, name, rows):
+
+    keys, columns = TABLES[table]
+    previous = await get_snapshot(table, name)
+
+    changes = {
+        'inserted': {key: row for key, row in rows.items() if key not in previous},
+        'updated': {key: row for key, row in rows.items() if key in previous and previous[key] != row},
+        'removed': [key for key in previous if key not in rows],
+    }
+
+    statements = []
+
+    if changes['removed']:
+        statements.append((
+            'delete from {} where {};'.format(table, ' and '.join(key + ' = ?' for key in keys)),
+            changes['removed'],
+        ))
+
+    if changes['inserted'] or changes['updated']:
+        statements.append((
+            'insert or replace into {} ({}) values ({});'.format(table, ', '.join(columns), ', '.join('?' * len(columns))),
+            list(changes['inserted'].values()) + list(changes['updated'].values()),
+        ))
+
+    if not statements:
+        return changes
+
+    try:
+        await write(*statements, table=table)
+    except Exception:
+        _snapshots.pop((table, name), None)
+        raise
+
+    _snapshots[(table, name)] = rows
+
+    for callback in list(_listeners):
+        callback(table, name, changes)
+
+    return changes
 
 async def set_prices(name, prices):
 
     if not prices:
         return
 
-    async with aiosqlite.connect(DB) as db:
-        await db.execute('delete from prices where exchange = ?;', (name,))
-        await db.commit()
-        for symbol, price in prices.items():
-            values = (name, symbol, price)
-            await db.execute('insert into prices (exchange, symbol, price) values (?, ?, ?)', values)
+    rows = {(name, symbol): (name, symbol, float(price)) for symbol, price in prices.items()}
 
-        await db.commit()
+    return await sync('prices', name, rows)
 
 async def set_orders(name, orders):
 
-    if not orders:
+    ''' Sync open orders, None (failed to fetch) keeps the stored ones '''
+
+    if orders is None:
         return
 
-    async with aiosqlite.connect(DB) as db:
-        await db.execute('delete from orders where exchange = ?', (name,))
-        await db.commit()
-        for order in orders:
-            values = (
-                order.get('id'),
-                name,
-                order.get('symbol'),
-                order.get('side'),
-                order.get('quantity'),
-                order.get('price'),
-            )
-            await db.execute('insert into orders (id, exchange, symbol, side, quantity, price) values (?, ?, ?, ?, ?, ?)', values)
+    rows = {}
+    for order in orders:
+        row = (
+            order.id,
+            name,
+            order.symbol,
+            order.side,
+            float(order.quantity),
+            float(order.price),
+        )
+        rows[row[:2]] = row
 
-        await db.commit()
+    return await sync('orders', name, rows)
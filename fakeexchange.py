@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  fakeexchange.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+''' Local stand-in for the HitBTC v2 and C-CEX APIs
+
+Serves synthetic (or recorded, see --replay) payloads with configurable
+size, latency and error rate:
+
+    python3 fakeexchange.py --symbols 1000 --latency 0.05 --errors 0.01
+
+then point the exchanges in btc.cfg to it:
+
+    "api": "http://localhost:8081"      (HitBTC, also "ws": "ws://localhost:8081/api/2/ws")
+    "api": "http://localhost:8081/t"    (Ccex)
+
+With --reports N an open order is filled every N seconds and the fill and
+its replacement are pushed as `report`s to websockets subscribed to them.
+'''
+
+from aiohttp import web, WSMsgType
+import argparse
+import asyncio
+import json
+import os
+import random
+from datetime import datetime
+
+class FakeExchange(object):
+
+    def __init__(
+        self,
+        symbols=100,
+        balances=10,
+        orders=10,
+        fills=1,
+        latency=0,
+        jitter=0,
+        errors=0,
+        replay=None,
+        seed=None,
+    ):
+
+        ''' symbols: ticker size, balances/orders: per account,
+        fills: new filled orders per history request, latency/jitter:
+        seconds added to every response, errors: share of failed responses,
+        replay: directory with recorded <endpoint>.json payloads '''
+
+        self.random = random.Random(seed)
+        self.latency = latency
+        self.jitter = jitter
+        self.errors = errors
+        self.replay = replay
+        self.fills = fills
+        self.currencies = ['C{}'.format(i) for i in range(symbols)]
+        self.prices = {currency: self.random.uniform(1e-8, 0.1) for currency in self.currencies}
+        self.held = self.currencies[:balances]
+        self.orders = [self.new_order(i) for i in range(orders)]
+        self.history = []
+        self.order_id = orders
+        self.requests = 0
+        # websockets subscribed to reports, symbols subscribed to tickers
+        self.reporting = set()
+        self.tickers = set()
+
+    def new_order(self, order_id, status='new'):
+
+        currency = self.random.choice(self.held or self.currencies)
+
+        return {
+            'id': order_id,
+            'clientOrderId': 'fake{}'.format(order_id),
+            'symbol': currency + 'BTC',
+            'side': self.random.choice(('buy', 'sell')),
+            'status': status,
+            'quantity': '{:.2f}'.format(self.random.uniform(1, 1000)),
+            'price': '{:.9f}'.format(self.prices[currency]),
+            'cumQuantity': '0',
+            'createdAt': datetime.utcnow().isoformat() + 'Z',
+            'updatedAt': datetime.utcnow().isoformat() + 'Z',
+        }
+
+    def tick(self):
+
+        ''' Move prices a little, as between two polls '''
+
+        for currency in self.random.sample(self.currencies, max(1, len(self.currencies) // 10)):
+            self.prices[currency] *= self.random.uniform(0.99, 1.01)
+
+    def fill(self):
+
+        for i in range(self.fills):
+            self.order_id += 1
+            self.history.insert(0, self.new_order(self.order_id, status='filled'))
+        del self.history[100:]
+
+    async def execute(self):
+
+        ''' Fill an open order and place a new one, pushing both as reports '''
+
+        filled = dict(self.orders.pop(0), status='filled', updatedAt=datetime.utcnow().isoformat() + 'Z')
+        filled['cumQuantity'] = filled['quantity']
+        self.history.insert(0, filled)
+        del self.history[100:]
+
+        self.order_id += 1
+        placed = self.new_order(self.order_id)
+        self.orders.append(placed)
+
+        for order, kind in ((filled, 'trade'), (placed, 'new')):
+            for ws in list(self.reporting):
+                await ws.send_json({'jsonrpc': '2.0', 'method': 'report', 'params': dict(order, reportType=kind)})
+
+        return filled, placed
+
+    async def respond(self, name, payload, error):
+
+        self.requests += 1
+
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+
+        if self.errors and self.random.random() < self.errors:
+            if self.random.random() < 0.5:
+                return web.Response(status=502, text='Bad Gateway')
+            return web.json_response(error)
+
+        if self.replay:
+            filename = os.path.join(self.replay, name + '.json')
+            if os.path.exists(filename):
+                with open(filename) as f:
+                    return web.Response(text=f.read(), content_type='application/json')
+
+        return web.json_response(payload())
+
+    # HitBTC v2
+
+    def hitbtc_error(self):
+
+        return {'error': {'code': 500, 'message': 'Internal Server Error'}}
+
+    async def hitbtc_ticker(self, request):
+
+        symbols = request.query.get('symbols')
+        symbols = set(symbols.split(',')) if symbols else None
+
+        def payload():
+            self.tick()
+            now = datetime.utcnow().isoformat() + 'Z'
+            return [
+                {
+                    'symbol': currency + 'BTC',
+                    'ask': '{:.9f}'.format(price * 1.001),
+                    'bid': '{:.9f}'.format(price * 0.999),
+                    'last': '{:.9f}'.format(price),
+                    'open': '{:.9f}'.format(price),
+                    'low': '{:.9f}'.format(price * 0.9),
+                    'high': '{:.9f}'.format(price * 1.1),
+                    'volume': '1000',
+                    'volumeQuote': '{:.9f}'.format(price * 1000),
+                    'timestamp': now,
+                }
+                for currency, price in self.prices.items()
+                if symbols is None or currency + 'BTC' in symbols
+            ]
+
+        return await self.respond('ticker', payload, self.hitbtc_error())
+
+    def hitbtc_balances(self):
+
+        return [
+            {'currency': currency, 'available': '{:.8f}'.format(self.random.uniform(0, 100)), 'reserved': '0'}
+            for currency in self.held + ['BTC']
+        ]
+
+    async def hitbtc_balance(self, request):
+
+        return await self.respond('balance', self.hitbtc_balances, self.hitbtc_error())
+
+    async def hitbtc_orders(self, request):
+
+        return await self.respond('order', lambda: self.orders, self.hitbtc_error())
+
+    async def hitbtc_history(self, request):
+
+        def payload():
+            self.fill()
+            limit = int(request.query.get('limit', 100))
+            offset = int(request.query.get('offset', 0))
+            history = self.history
+            if 'from' in request.query:
+                history = [order for order in history if order['updatedAt'] >= request.query['from']]
+            return history[offset:offset + limit]
+
+        return await self.respond('history', payload, self.hitbtc_error())
+
+    async def hitbtc_ws(self, request):
+
+        ''' Minimal json-rpc websocket: login, subscriptions, trading balance '''
+
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+
+        try:
+            await self.serve_ws(ws)
+        finally:
+            self.reporting.discard(ws)
+
+        return ws
+
+    async def serve_ws(self, ws):
+
+        async for msg in ws:
+            if msg.type != WSMsgType.TEXT:
+                continue
+
+            message = json.loads(msg.data)
+            method = message.get('method')
+            params = message.get('params') or {}
+
+            if method == 'getTradingBalance':
+                await ws.send_json({'jsonrpc': '2.0', 'result': self.hitbtc_balances(), 'id': message.get('id')})
+                continue
+
+            await ws.send_json({'jsonrpc': '2.0', 'result': True, 'id': message.get('id')})
+
+            if method == 'subscribeReports':
+                self.reporting.add(ws)
+                await ws.send_json({'jsonrpc': '2.0', 'method': 'activeOrders', 'params': self.orders})
+            elif method == 'subscribeTicker':
+                currency = params.get('symbol', '')[:-len('BTC')]
+                if currency in self.prices:
+                    self.tickers.add(params['symbol'])
+                    await ws.send_json({'jsonrpc': '2.0', 'method': 'ticker', 'params': {
+                        'symbol': params['symbol'],
+                        'last': '{:.9f}'.format(self.prices[currency]),
+                    }})
+
+    # C-CEX
+
+    def ccex_error(self):
+
+        return {'success': False, 'message': 'Internal error', 'result': None}
+
+    async def ccex_prices(self, request):
+
+        def payload():
+            self.tick()
+            return {
+                currency.lower() + '-btc': {
+                    'high': price * 1.1,
+                    'low': price * 0.9,
+                    'avg': price,
+                    'lastbuy': price * 0.999,
+                    'lastsell': price * 1.001,
+                    'buy': price * 0.999,
+                    'sell': price * 1.001,
+                    'lastprice': price,
+                    'updated': 0,
+                }
+                for currency, price in self.prices.items()
+            }
+
+        return await self.respond('prices', payload, self.ccex_error())
+
+    async def ccex_pair(self, request):
+
+        currency = request.match_info['pair'].upper()[:-len('-BTC')]
+
+        if currency not in self.prices:
+            return web.json_response({'success': False, 'message': 'unknown pair', 'result': None})
+
+        def payload():
+            price = self.prices[currency]
+            return {'ticker': {'high': price * 1.1, 'low': price * 0.9, 'lastprice': price, 'updated': 0}}
+
+        return await self.respond('pair', payload, self.ccex_error())
+
+    async def ccex_api(self, request):
+
+        action = request.query.get('a')
+
+        if action == 'getbalances':
+            def payload():
+                result = []
+                for currency in self.held + ['BTC']:
+                    available = self.random.uniform(0, 100)
+                    result.append({'Currency': currency, 'Available': available, 'Balance': available * 1.5})
+                return {'success': True, 'message': '', 'result': result}
+
+        elif action == 'getopenorders':
+            def payload():
+                return {'success': True, 'message': '', 'result': [
+                    {
+                        'OrderUuid': order['clientOrderId'],
+                        'Exchange': order['symbol'][:-len('BTC')].lower() + '-btc',
+                        'OrderType': 'LIMIT_BUY' if order['side'] == 'buy' else 'LIMIT_SELL',
+                        'Quantity': float(order['quantity']),
+                        'Limit': float(order['price']),
+                    }
+                    for order in self.orders
+                ]}
+
+        elif action == 'getorderhistory':
+            def payload():
+                self.fill()
+                count = int(request.query.get('count', 100))
+                return {'success': True, 'message': '', 'result': [
+                    {
+                        'OrderUuid': order['clientOrderId'],
+                        'Exchange': order['symbol'][:-len('BTC')].lower() + '-btc',
+                        'OrderType': 'LIMIT_BUY' if order['side'] == 'buy' else 'LIMIT_SELL',
+                        'Quantity': float(order['quantity']),
+                        'PricePerUnit': float(order['price']),
+                        'QuantityRemaining': 0,
+                        'TimeStamp': order['updatedAt'],
+                    }
+                    for order in self.history[:count]
+                ]}
+
+        else:
+            return web.json_response({'success': False, 'message': 'unknown action', 'result': None})
+
+        return await self.respond(action, payload, self.ccex_error())
+
+    async def report_every(self, interval):
+
+        while True:
+            await asyncio.sleep(interval)
+            if self.orders:
+                await self.execute()
+
+    def app(self, reports=None):
+
+        app = web.Application()
+
+        if reports:
+            async def start_reports(app):
+                app['reports'] = asyncio.ensure_future(self.report_every(reports))
+
+            async def stop_reports(app):
+                app['reports'].cancel()
+
+            app.on_startup.append(start_reports)
+            app.on_cleanup.append(stop_reports)
+
+        app.router.add_get('/api/2/public/ticker/', self.hitbtc_ticker)
+        app.router.add_get('/api/2/trading/balance', self.hitbtc_balance)
+        app.router.add_get('/api/2/order', self.hitbtc_orders)
+        app.router.add_get('/api/2/history/order', self.hitbtc_history)
+        app.router.add_get('/api/2/ws', self.hitbtc_ws)
+        app.router.add_get('/t/prices.json', self.ccex_prices)
+        app.router.add_get('/t/{pair}.json', self.ccex_pair)
+        app.router.add_get('/t/api.html', self.ccex_api)
+
+        return app
+
+    async def start(self, host='localhost', port=8081, reports=None):
+
+        self.runner = web.AppRunner(self.app(reports), access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+
+    async def stop(self):
+
+        await self.runner.cleanup()
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Fake HitBTC/C-CEX API server')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--symbols', type=int, default=100)
+    parser.add_argument('--balances', type=int, default=10)
+    parser.add_argument('--orders', type=int, default=10)
+    parser.add_argument('--fills', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--errors', type=float, default=0)
+    parser.add_argument('--reports', type=float, help='seconds between order fills pushed over the websocket')
+    parser.add_argument('--replay', help='directory with recorded <endpoint>.json payloads '
+        '(ticker, balance, order, history, prices, getbalances, getopenorders, getorderhistory)')
+    args = parser.parse_args()
+
+    exchange = FakeExchange(
+        symbols=args.symbols,
+        balances=args.balances,
+        orders=args.orders,
+        fills=args.fills,
+        latency=args.latency,
+        jitter=args.jitter,
+        errors=args.errors,
+        replay=args.replay,
+    )
+
+    web.run_app(exchange.app(args.reports), host=args.host, port=args.port)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  hitbtc.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from aiohttp import BasicAuth, WSMsgType
+import asyncio
+import json
+import uuid
+from collections import deque
+import clients
+from clients import Balance, Order, Exchange, ApiError
+
+def keep_last(ticker):
+
+    if isinstance(ticker, dict) and ticker.get('symbol') and ticker.get('last'):
+        return ticker['symbol'], ticker['last']
+
+class HitBTC(Exchange):
+
+    ''' Connect to exchange, get some stuff '''
+
+    def __init__(
+        self,
+        url="https://hitbtc.com",
+        api_url="https://api.hitbtc.com",
+        *args,
+        stream=False,
+        ws_url="wss://api.hitbtc.com/api/2/ws",
+        **kwargs
+    ):
+
+        super().__init__(url, api_url + "/api/2", *args, **kwargs)
+
+        self.ws_url = ws_url
+        self.auth = BasicAuth(login=self.login, password=self.password)
+
+        # websocket live view, see run_stream()
+        self.stream = stream
+        self.stream_task = None
+        self.live = False
+        self.live_prices = {}
+        self.live_orders = {}
+        self.live_history = deque(maxlen=100)
+        self.live_balance = {}
+        self.rpc_id = 0
+        self.rpc_pending = {}
+        self.ws = None
+
+    async def close(self):
+
+        if self.stream_task:
+            self.stream_task.cancel()
+            try:
+                await self.stream_task
+            except asyncio.CancelledError:
+                pass
+            self.stream_task = None
+
+    def get_live_data(self):
+
+        ''' Return data from the websocket live view once it is connected '''
+
+        if not self.stream:
+            return
+
+        if not self.stream_task:
+            self.stream_task = asyncio.ensure_future(self.run_stream())
+
+        if self.live:
+            return self.normalize(
+                dict(self.live_balance),
+                list(self.live_orders.values()),
+                list(self.live_history),
+                dict(self.live_prices),
+            )
+
+    async def run_stream(self):
+
+        ''' Keep the live view updated from the websocket
+
+        Every (re)connection first resyncs the live view over REST to cover
+        whatever was missed while disconnected, then logs in and subscribes
+        to order reports and to tickers of all known symbols. get_data()
+        falls back to REST polling until this succeeds.
+        '''
+
+        delay = 1
+
+        while True:
+            try:
+                await self.resync()
+                async with self.session.ws_connect(self.ws_url, heartbeat=30, auth=self.auth, proxy=self.proxy) as ws:
+                    self.ws = ws
+                    reader = asyncio.ensure_future(self.read_stream(ws))
+                    try:
+                        await self.subscribe()
+                        self.live = True
+                        delay = 1
+                        self.logger.info('stream connected')
+                        await reader
+                    finally:
+                        reader.cancel()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.error('stream: {}'.format(e))
+            finally:
+                self.live = False
+                self.ws = None
+                for future in self.rpc_pending.values():
+                    if not future.done():
+                        future.set_exception(ConnectionError('stream closed'))
+                self.rpc_pending = {}
+
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+
+    async def resync(self):
+
+        ''' Refill the live view from REST endpoints '''
+
+        balance, orders, history, prices = await asyncio.gather(
+            self.get_balance(),
+            self.get_orders(),
+            self.get_history(cursor=self.history_cursor),
+            self.get_prices(),
+        )
+
+        if prices:
+            self.live_prices.update(prices)
+        if balance:
+            self.live_balance = balance
+        self.live_orders = {order.id: order for order in orders}
+        known = {order.id for order in self.live_history}
+        for order in reversed(history or []):
+            if order.id not in known:
+                self.live_history.appendleft(order)
+
+    async def subscribe(self):
+
+        await self.rpc('login', {'algo': 'BASIC', 'pKey': self.login, 'sKey': self.password})
+        await asyncio.gather(
+            self.rpc('subscribeReports'),
+            *(self.rpc('subscribeTicker', {'symbol': symbol}) for symbol in self.live_prices)
+        )
+
+    async def rpc(self, method, params=None):
+
+        ''' Send a json-rpc request over the websocket and wait for its result '''
+
+        self.rpc_id += 1
+        future = self.loop.create_future()
+        self.rpc_pending[self.rpc_id] = future
+
+        await self.ws.send_str(json.dumps({'method': method, 'params': params or {}, 'id': self.rpc_id}))
+
+        return await asyncio.wait_for(future, self.timeout)
+
+    async def read_stream(self, ws):
+
+        async for msg in ws:
+            if msg.type == WSMsgType.TEXT:
+                self.handle_message(clients.loads(msg.data))
+            elif msg.type == WSMsgType.ERROR:
+                break
+
+    def handle_message(self, message):
+
+        future = self.rpc_pending.pop(message.get('id'), None)
+        if future and not future.done():
+            if 'error' in message:
+                future.set_exception(Exception(message['error']))
+            else:
+                future.set_result(message.get('result'))
+            return
+
+        method = message.get('method')
+        params = message.get('params')
+
+        if method == 'ticker':
+            if params.get('symbol') and params.get('last'):
+                self.live_prices[params['symbol']] = clients.number(params['last'])
+
+        elif method == 'activeOrders':
+            self.live_orders = {order.id: order for order in map(self.parse_order, params)}
+
+        elif method == 'report':
+            order = self.parse_order(params)
+            if order.status in ('new', 'suspended', 'partiallyFilled'):
+                self.live_orders[order.id] = order
+            else:
+                self.live_orders.pop(order.id, None)
+            if order.status == 'filled':
+                self.live_history.appendleft(order)
+            asyncio.ensure_future(self.refresh_balance())
+
+    async def refresh_balance(self):
+
+        try:
+            balances = await self.rpc('getTradingBalance')
+        except Exception as e:
+            self.logger.error('balance: {}'.format(e))
+            return
+
+        self.live_balance = self.filter_balance(balances)
+
+    async def get_response(
+        self,
+        method='GET',
+        url=None,
+        params={},
+        endpoint=None,
+        keep=None,
+    ):
+
+        ''' Get response, raise ExchangeError if there is none '''
+
+        if endpoint is None:
+            endpoint = url[len(self.api_url):]
+
+        return await self.request(
+            method,
+            url,
+            endpoint,
+            keep=keep,
+            hedge=method == 'GET',
+            signed='/public/' not in url,
+            params=params,
+            auth=self.auth,
+        )
+
+    def decode(self, endpoint, status, body):
+
+        jresp = super().decode(endpoint, status, body)
+
+        if isinstance(jresp, dict) and 'error' in jresp:
+            raise ApiError('{}: {}'.format(endpoint, jresp['error']))
+
+        return jresp
+
+    async def get_balance(self):
+
+        ''' Return currency list with positive available or reserved balance '''
+
+        self.logger.info('get balance')
+
+        url = "{}/trading/balance".format(self.api_url)
+
+        balances = await self.get_response(url=url)
+
+        return self.filter_balance(balances)
+
+    def filter_balance(self, balances):
+
+        ret = {}
+
+        if balances:
+            for x in balances:
+                balance = Balance(x['currency'], x['available'], x['reserved'])
+
+                if balance.available > 0 or balance.reserved > 0:
+                    ret[balance.currency] = balance
+
+        return ret
+
+    def parse_order(self, x):
+
+        return Order(
+            id=x['id'],
+            symbol=x['symbol'],
+            side=x['side'],
+            quantity=x['quantity'],
+            price=x.get('price') or 0,
+            status=x['status'],
+            updated=x.get('updatedAt'),
+        )
+
+    async def get_orders(self):
+
+        ''' Return active orders for exchange '''
+
+        self.logger.info('get orders')
+
+        url = "{}/order".format(self.api_url)
+
+        orders = await self.get_response(url=url)
+
+        if orders:
+            return [self.parse_order(x) for x in orders]
+        else:
+            return []
+
+    async def get_order(self, order_id):
+
+        ''' Return order by order id '''
+
+        self.logger.info('get order {}'.format(order_id))
+
+        url = "{}/order/{}".format(self.api_url, order_id)
+
+        order = await self.get_response(url=url, endpoint='/order/:id')
+
+        return order
+
+    async def get_history(self, limit=20, cursor=None, page=100):
+
+        ''' Return filled orders for exchange
+
+        Without a cursor the last `limit` orders. With a cursor (updatedAt of
+        the newest known order) all orders updated from then on, newest
+        first, fetched `page` orders at a time so a long gap is backfilled.
+        '''
+
+        self.logger.info('get history')
+
+        url = "{}/history/order".format(self.api_url)
+
+        if not cursor:
+            history_trades = await self.get_response(url=url, params={'sort': 'desc', 'limit': limit})
+            return [self.parse_order(x) for x in history_trades]
+
+        ret = []
+        offset = 0
+
+        while True:
+            params = {'sort': 'desc', 'from': cursor, 'limit': page, 'offset': offset}
+            history_trades = await self.get_response(url=url, params=params)
+
+            orders = [self.parse_order(x) for x in history_trades]
+            newer = [order for order in orders if (order.updated or '') >= cursor]
+            ret.extend(newer)
+
+            if len(orders) < page or len(newer) < len(orders):
+                return ret
+
+            offset += page
+
+    async def get_prices(self, symbols=None):
+
+        ''' Return prices, of the given symbols only with one filtered request '''
+
+        self.logger.info('get prices')
+
+        url = "{}/public/ticker/".format(self.api_url)
+
+        if symbols:
+            tickers = await self.get_response(url=url, params={'symbols': ','.join(sorted(symbols))})
+        elif clients.stream:
+            pairs = await self.get_response(url=url, keep=keep_last)
+            return {symbol: clients.number(last) for symbol, last in pairs or ()}
+        else:
+            tickers = await self.get_response(url=url)
+
+        prices = {}
+
+        if tickers:
+
+            for ticker in tickers:
+                last = ticker.get('last')
+                symbol = ticker.get('symbol')
+
+                if symbol and last:
+                    prices[symbol] = clients.number(last)
+
+        return prices
+
+    async def new_order(self, symbol, side, quantity, price):
+
+        self.logger.info('place new order in {}'.format(symbol))
+
+        order_id = uuid.uuid4().hex
+
+        params = {
+            'symbol': symbol,
+            'side': side,
+            'quantity': quantity,
+            'price': price,
+        }
+
+        url = "{}/order/{}".format(self.api_url, order_id)
+
+        response = await self.get_response(method='PUT', url=url, params=params, endpoint='/order/:id')
+
+        return response
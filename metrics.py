@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  metrics.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+''' Counters, gauges and histograms in the Prometheus text format
+
+Metrics are plain in-process objects, render() produces the /metrics page.
+Timings observed while a trace is active (see start_trace) are also
+collected as spans so a whole poll cycle can be dumped to a file.
+'''
+
+import asyncio
+import json
+from bisect import bisect_left
+from contextvars import ContextVar
+from time import perf_counter, time
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+REGISTRY = []
+
+_trace = ContextVar('trace', default=None)
+
+def format_labels(labels):
+
+    if not labels:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('"', '\\"')) for key, value in labels) + '}'
+
+class Metric(object):
+
+    kind = None
+
+    def __init__(self, name, description):
+
+        self.name = name
+        self.description = description
+        self.values = {}
+        REGISTRY.append(self)
+
+    def render(self):
+
+        lines = [
+            '# HELP {} {}'.format(self.name, self.description),
+            '# TYPE {} {}'.format(self.name, self.kind),
+        ]
+        for labels, value in sorted(self.values.items()):
+            lines.append('{}{} {}'.format(self.name, format_labels(labels), value))
+
+        return lines
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, value=1, **labels):
+
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + value
+
+class Gauge(Metric):
+
+    kind = 'gauge'
+
+    def __init__(self, name, description):
+
+        super().__init__(name, description)
+        self.functions = {}
+
+    def set(self, value, **labels):
+
+        self.values[tuple(sorted(labels.items()))] = value
+
+    def set_function(self, function, **labels):
+
+        ''' Read the value from function() at render time '''
+
+        self.functions[tuple(sorted(labels.items()))] = function
+
+    def render(self):
+
+        for labels, function in self.functions.items():
+            self.values[labels] = function()
+
+        return super().render()
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets=BUCKETS):
+
+        super().__init__(name, description)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+
+        key = tuple(sorted(labels.items()))
+        counts = self.values.get(key)
+        if counts is None:
+            # per bucket counts, overflow, count and sum
+            counts = self.values[key] = [0] * (len(self.buckets) + 3)
+
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-2] += 1
+        counts[-1] += value
+
+        trace = _trace.get()
+        if trace is not None:
+            trace.append((self.name, dict(labels), value))
+
+    def time(self, **labels):
+
+        return Timer(self, labels)
+
+    def render(self):
+
+        lines = [
+            '# HELP {} {}'.format(self.name, self.description),
+            '# TYPE {} {}'.format(self.name, self.kind),
+        ]
+
+        for labels, counts in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(self.name, format_labels(labels + (('le', bound),)), cumulative))
+            lines.append('{}_bucket{} {}'.format(self.name, format_labels(labels + (('le', '+Inf'),)), counts[-2]))
+            lines.append('{}_count{} {}'.format(self.name, format_labels(labels), counts[-2]))
+            lines.append('{}_sum{} {}'.format(self.name, format_labels(labels), counts[-1]))
+
+        return lines
+
+class Timer(object):
+
+    ''' with histogram.time(**labels): observes the duration of the block '''
+
+    def __init__(self, histogram, labels):
+
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+
+        self.histogram.observe(perf_counter() - self.start, **self.labels)
+
+HTTP_REQUESTS = Counter('btc_http_requests_total', 'Exchange API requests by status')
+HTTP_BYTES = Counter('btc_http_response_bytes_total', 'Exchange API response bytes')
+HTTP_SECONDS = Histogram('btc_http_request_seconds', 'Exchange API request latency')
+PHASE_SECONDS = Histogram('btc_get_data_phase_seconds', 'Duration of get_data phases')
+CYCLE_SECONDS = Histogram('btc_poll_cycle_seconds', 'Duration of a whole poll cycle')
+DB_WRITE_SECONDS = Histogram('btc_db_write_seconds', 'Duration of database write transactions')
+DB_ROWS = Counter('btc_db_rows_written_total', 'Rows written to the database')
+QUEUE_SIZE = Gauge('btc_queue_size', 'Items waiting in internal queues')
+HTTP_HEDGED = Counter('btc_http_hedged_requests_total', 'Exchange API requests sent again after the hedge delay')
+CIRCUIT_OPEN = Gauge('btc_circuit_open', 'Whether the circuit breaker of an exchange is open')
+SLOW_CALLBACKS = Counter('btc_slow_callbacks_total', 'Event loop stalls longer than the profiling threshold')
+LOOP_LAG = Histogram('btc_event_loop_lag_seconds', 'Event loop scheduling lag', buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+
+def render():
+
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+
+    return '\n'.join(lines) + '\n'
+
+async def monitor_loop_lag(interval=0.5):
+
+    ''' Observe how late the loop wakes up a sleeping task '''
+
+    loop = asyncio.get_event_loop()
+
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0, loop.time() - start - interval))
+
+def start_trace():
+
+    ''' Collect spans observed by this task and the tasks it creates '''
+
+    trace = []
+    _trace.set(trace)
+
+    return trace
+
+def dump_trace(path, name, trace, duration):
+
+    ''' Append a cycle trace as one JSON line '''
+
+    record = {
+        'time': time(),
+        'exchange': name,
+        'seconds': duration,
+        'spans': [{'metric': metric, 'labels': labels, 'seconds': value} for metric, labels, value in trace],
+    }
+
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  notifier.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+import asyncio
+import logging
+import db
+import metrics
+
+MAX_LENGTH = 4096
+
+def format_fill(row):
+
+    return "{}: {} {} {} for {:.9f}".format(
+        row[1], #exchange
+        row[2], #symbol
+        row[3], #side
+        row[5], #quantity
+        row[4], #price
+    )
+
+class Notifier(object):
+
+    ''' Deliver fill and alert notifications in the background
+
+    Fills queued with put() and alerts with put_alert() are collected for
+    `window` seconds, grouped into one message per exchange and sent through
+    `send` at most `rate` messages per second, retrying with exponential
+    backoff. Delivered fills are marked confirmed in one batch.
+    '''
+
+    def __init__(self, send, window=2, rate=1, retries=5):
+
+        self.send = send
+        self.window = window
+        self.interval = 1 / rate
+        self.retries = retries
+        self.queue = asyncio.Queue()
+        # key: item queued or being delivered
+        self.pending = {}
+        self.last_sent = 0
+        self.task = None
+        self.logger = logging.getLogger(self.__class__.__name__)
+        metrics.QUEUE_SIZE.set_function(lambda: self.queue.qsize() + len(self.pending), queue='notifier')
+
+    def start(self):
+
+        if not self.task:
+            self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def put(self, row):
+
+        ''' Queue a history row unless it is already waiting for delivery '''
+
+        self.enqueue(('fill', row[0], row[1]), row[1], format_fill(row), (row[0], row[1]))
+
+    def put_alert(self, alert_id, exchange, text):
+
+        self.enqueue(('alert', alert_id), exchange, text, None)
+
+    def enqueue(self, key, exchange, text, confirm):
+
+        ''' Queue (key, exchange, text, history key to confirm or None) '''
+
+        if key not in self.pending:
+            item = self.pending[key] = (key, exchange, text, confirm)
+            self.queue.put_nowait(item)
+
+    def unsent(self):
+
+        ''' Return the alert items not delivered yet, fills are kept in db '''
+
+        return [item for key, item in self.pending.items() if key[0] == 'alert']
+
+    async def run(self):
+
+        while True:
+            rows = [await self.queue.get()]
+            await asyncio.sleep(self.window)
+            while not self.queue.empty():
+                rows.append(self.queue.get_nowait())
+
+            batches = {}
+            for item in rows:
+                batches.setdefault(item[1], []).append(item)
+
+            for exchange, batch in batches.items():
+                try:
+                    await self.deliver(batch)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.logger.error("{}: {}".format(exchange, e))
+                finally:
+                    for item in batch:
+                        self.pending.pop(item[0], None)
+
+    async def deliver(self, items):
+
+        for chunk in self.split(items):
+            text = "\n".join(item[2] for item in chunk)
+            delay = 1
+
+            for attempt in range(self.retries):
+                await self.throttle()
+                response = await self.send(text)
+                if response and response.get('ok'):
+                    await db.set_history_confirmed_many([item[3] for item in chunk if item[3]])
+                    break
+                await asyncio.sleep(delay)
+                delay *= 2
+            else:
+                self.logger.error("giving up after {} attempts".format(self.retries))
+
+    def split(self, items):
+
+        ''' Split items into chunks that fit in one message '''
+
+        chunk = []
+        length = 0
+
+        for item in items:
+            size = len(item[2]) + 1
+            if chunk and length + size > MAX_LENGTH:
+                yield chunk
+                chunk = []
+                length = 0
+            chunk.append(item)
+            length += size
+
+        if chunk:
+            yield chunk
+
+    async def throttle(self):
+
+        loop = asyncio.get_event_loop()
+        delay = self.last_sent + self.interval - loop.time()
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        self.last_sent = loop.time()
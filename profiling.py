@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  profiling.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+''' Opt-in sampling profiler of the event loop
+
+A background thread samples the stack of the event loop thread every
+`interval` seconds and keeps the last `keep` seconds of samples. The loop
+sets a heartbeat as often; when it is late by more than `slow_callback`
+seconds a callback is blocking the loop, and its stack is logged once per
+stall. After a poll cycle over its budget btc.poll() calls dump(), which
+writes the samples taken during the cycle as collapsed stacks, one
+"frame;frame;... count" line per stack, for flamegraph.pl or speedscope.
+Cycles of other clients running at the same time are part of the samples.
+'''
+
+import logging
+import os
+import sys
+import threading
+import traceback
+from collections import Counter, deque
+from time import strftime
+
+import metrics
+
+logger = logging.getLogger('profiling')
+
+def collapse(frame):
+
+    ''' Return the stack of frame as "file:function:line;..." outermost first '''
+
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('{}:{}:{}'.format(os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+        frame = frame.f_back
+
+    return ';'.join(reversed(stack))
+
+class Profiler(object):
+
+    def __init__(self, path='profiles', interval=0.005, slow_callback=0.1, keep=120):
+
+        self.path = path
+        self.interval = interval
+        self.slow_callback = slow_callback
+        self.keep = keep
+        # (loop time, collapsed stack)
+        self.samples = deque()
+        self.loop = None
+        self.thread_id = None
+        self.beat = 0
+        self.stalled = False
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self, loop):
+
+        ''' Profile loop, from the thread running it '''
+
+        self.loop = loop
+        self.thread_id = threading.get_ident()
+        self.heartbeat()
+        self.thread = threading.Thread(target=self.run, name='btc-profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def heartbeat(self):
+
+        self.beat = self.loop.time()
+        if not self.stopped.is_set():
+            self.loop.call_later(self.interval, self.heartbeat)
+
+    def run(self):
+
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+
+            now = self.loop.time()
+            self.samples.append((now, collapse(frame)))
+            while self.samples[0][0] < now - self.keep:
+                self.samples.popleft()
+
+            blocked = now - self.beat - self.interval
+            if blocked > self.slow_callback:
+                if not self.stalled:
+                    self.stalled = True
+                    metrics.SLOW_CALLBACKS.inc()
+                    logger.warning("event loop blocked for {:.3f}s in:\n{}".format(
+                        blocked, ''.join(traceback.format_stack(frame))))
+            else:
+                self.stalled = False
+
+    def dump(self, name, start, end):
+
+        ''' Write the samples between loop times start and end, return the file name '''
+
+        stacks = Counter(stack for at, stack in list(self.samples) if start <= at <= end)
+        if not stacks:
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+        filename = os.path.join(self.path, '{}-{}.txt'.format(name.replace(':', '_'), strftime('%Y%m%d-%H%M%S')))
+
+        with open(filename, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+
+        return filename
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  shards.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+''' Polling of accounts in worker processes
+
+With "workers": N in btc.cfg the accounts are dealt round-robin to N
+processes, each polling its share on its own event loop and sending
+(account, data) to the main process, which alone writes the database and
+serves the web app. The ticker of an exchange is fetched by one worker
+only (the one of its first account); the main process forwards new prices
+to the other workers with accounts there, and workers send prices only
+when they changed. After the first feed only the prices just fetched
+(data['fresh'], see clients.Ticker) cross processes, each process merges
+them into its own copy. The main process also tells the fetching worker which
+symbols have alerts, see btc.want_alert_symbols(). A worker moves the
+history cursor of an account only once the main process acknowledged that
+it stored the fills before it.
+'''
+
+import asyncio
+import logging
+import multiprocessing
+import queue
+
+from clients import get_ticker, configure_sessions, close_sessions, set_precision, set_decoder, set_offload
+
+logger = logging.getLogger('shards')
+
+class Supervisor(object):
+
+    def __init__(self, config, jobs, workers):
+
+        ''' jobs: (exchange, account, cursor) as for btc.start_polls() '''
+
+        self.config = config
+        self.shards = [[] for i in range(workers)]
+        # exchange: index of the shard fetching its ticker
+        self.owners = {}
+        # shard index: exchanges with accounts there
+        self.exchanges = [set() for i in range(workers)]
+        # account: shard index
+        self.accounts = {}
+
+        for i, job in enumerate(jobs):
+            index = i % workers
+            name = job[0].get('name')
+            self.shards[index].append(job)
+            self.owners.setdefault(name, index)
+            self.exchanges[index].add(name)
+            self.accounts[job[1]['name']] = index
+
+        self.context = multiprocessing.get_context('spawn')
+        self.results = self.context.Queue()
+        self.inboxes = [self.context.Queue() for shard in self.shards]
+        self.processes = []
+
+    def start(self):
+
+        for index, jobs in enumerate(self.shards):
+            if not jobs:
+                continue
+            owned = [name for name, owner in self.owners.items() if owner == index]
+            process = self.context.Process(
+                target=run_worker,
+                args=(self.config, jobs, owned, self.results, self.inboxes[index]),
+                name='btc-worker-{}'.format(index),
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+
+    async def get(self):
+
+        ''' Return the next (account name, data), passing new prices on '''
+
+        loop = asyncio.get_event_loop()
+
+        while True:
+            try:
+                name, data = await loop.run_in_executor(None, self.results.get, True, 1)
+                break
+            except queue.Empty:
+                continue
+
+        exchange = data.get('exchange')
+        ticker = get_ticker(exchange)
+
+        if data.get('prices'):
+            ticker.update(data['prices'])
+            message = ('prices', exchange, data['prices'])
+        elif data.get('fresh'):
+            data['prices'] = ticker.merge(data['fresh'])
+            message = ('fresh', exchange, data['fresh'])
+        else:
+            return name, data
+
+        for index, inbox in enumerate(self.inboxes):
+            if index != self.owners.get(exchange) and exchange in self.exchanges[index]:
+                inbox.put(message)
+
+        return name, data
+
+    def stored(self, account, cursor):
+
+        ''' Acknowledge that the data of account up to cursor is stored '''
+
+        if account in self.accounts:
+            self.inboxes[self.accounts[account]].put(('cursor', account, cursor))
+
+    def want(self, exchange, symbols):
+
+        ''' Have the worker fetching the ticker of exchange fetch symbols '''
+
+        if exchange in self.owners:
+            self.inboxes[self.owners[exchange]].put(('want', exchange, symbols))
+
+    def stop(self, timeout=5):
+
+        for inbox in self.inboxes:
+            inbox.put(None)
+
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+        self.processes = []
+
+def run_worker(config, jobs, owned, results, inbox):
+
+    logging.basicConfig()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    try:
+        loop.run_until_complete(work(config, jobs, owned, results, inbox))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.close()
+
+async def work(config, jobs, owned, results, inbox):
+
+    ''' Poll jobs until the supervisor puts None in inbox '''
+
+    import btc
+
+    loop = asyncio.get_event_loop()
+
+    configure_sessions(**config.get('http', {}))
+    set_precision(config.get('precision', 'float'))
+    set_decoder(**config.get('json', {}))
+    set_offload(config.get('offload', ()))
+
+    profiler = btc.start_profiler(config, loop)
+
+    # exchange: prices dict last sent or received
+    sent = {}
+
+    async def send(client):
+
+        data = await client.get_data()
+
+        prices = data.get('prices')
+        # unchanged, or older than prices already fetched by another account
+        if not prices or sent.get(client.exchange) is prices or prices is not client.ticker.prices:
+            data['prices'] = None
+            data['fresh'] = None
+        else:
+            if client.exchange in sent and data.get('fresh') is not prices:
+                # the main process merges data['fresh'] into the prices it has
+                data['prices'] = None
+            sent[client.exchange] = prices
+
+        # the cursor moves on with the main process' ('cursor', ...) message
+        results.put((client.name, data))
+
+    clients, tasks = btc.start_polls(config, jobs, loop, handler=send, profiler=profiler)
+
+    accounts = {client.name: client for client in clients}
+
+    for client in clients:
+        if client.ticker:
+            client.ticker.owner = client.exchange in owned
+
+    try:
+        while True:
+            try:
+                message = await loop.run_in_executor(None, inbox.get, True, 1)
+            except queue.Empty:
+                continue
+
+            if message is None:
+                break
+
+            # name: exchange, or account for 'cursor'
+            kind, name, value = message
+            if kind == 'prices':
+                get_ticker(name).update(value)
+                sent[name] = value
+            elif kind == 'fresh':
+                sent[name] = get_ticker(name).merge(value)
+            elif kind == 'want':
+                get_ticker(name).want('alerts', value)
+            elif kind == 'cursor' and name in accounts:
+                accounts[name].history_cursor = value
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for client in clients:
+            await client.close()
+        await close_sessions()
+        if profiler:
+            profiler.stop()
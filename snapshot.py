@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  snapshot.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+''' Warm-start snapshot of the in-memory state
+
+What the database does not keep (balances, totals, orders near the market,
+time of the last cycle of each account, unsent alert notifications) and the
+last prices and open orders are written to one json file after polling
+cycles, at most every `interval` seconds and without holding up the cycle,
+and on shutdown. Loaded at startup before the first poll, it lets the
+web app, valuation and order alerts serve data at once; restored accounts
+are reported stale until their first live cycle.
+'''
+
+import asyncio
+import json
+import logging
+import os
+from time import time
+
+from clients import Balance, Order
+
+VERSION = 1
+
+logger = logging.getLogger('snapshot')
+
+class Snapshot(object):
+
+    def __init__(self, path='snapshot.json', interval=10):
+
+        ''' interval: least seconds between two writes after cycles '''
+
+        self.path = path
+        self.interval = interval
+        # account: {'exchange', 'updated', 'balance', 'orders', 'near', 'total'}
+        self.accounts = {}
+        # exchange: {symbol: price}
+        self.prices = {}
+        # notifier items (key, exchange, text, confirm)
+        self.unsent = []
+        self.saved = 0
+        # write in progress
+        self.task = None
+        # accounts restored and not polled since
+        self.stale = set()
+
+    def record(self, name, data, near=None):
+
+        ''' Keep the data of a cycle of account name, None keeps the last '''
+
+        account = self.accounts.setdefault(name, {})
+        account['exchange'] = data.get('exchange', name)
+        account['updated'] = time()
+
+        if data.get('balance') is not None:
+            account['balance'] = {
+                currency: (float(balance.available), float(balance.reserved))
+                for currency, balance in data['balance'].items()
+            }
+        if data.get('orders') is not None:
+            account['orders'] = [
+                (order.id, order.symbol, order.side, float(order.quantity), float(order.price))
+                for order in data['orders']
+            ]
+        if data.get('total') is not None:
+            account['total'] = float(data['total'])
+        if near is not None:
+            account['near'] = near
+        if data.get('prices'):
+            self.prices[account['exchange']] = data['prices']
+
+        self.stale.discard(name)
+
+    def get_balance(self, name):
+
+        balance = self.accounts.get(name, {}).get('balance')
+
+        if balance is not None:
+            return {currency: Balance(currency, *values) for currency, values in balance.items()}
+
+    def get_orders(self, name):
+
+        orders = self.accounts.get(name, {}).get('orders')
+
+        if orders is not None:
+            return [Order(*row) for row in orders]
+
+    def status(self):
+
+        ''' Return {account: {'exchange', 'updated', 'total', 'stale'}} '''
+
+        return {
+            name: {
+                'exchange': account['exchange'],
+                'updated': account['updated'],
+                'total': account.get('total'),
+                'stale': name in self.stale,
+            }
+            for name, account in self.accounts.items()
+        }
+
+    def state(self):
+
+        ''' Return a copy of what dump() writes, safe to dump in another thread
+
+        Accounts' values and price dicts are replaced, not changed, by
+        record() and the tickers: copying the containers is enough.
+        '''
+
+        return {name: dict(account) for name, account in self.accounts.items()}, dict(self.prices), list(self.unsent)
+
+    def dump(self, state):
+
+        accounts, prices, unsent = state
+
+        return json.dumps({
+            'version': VERSION,
+            'saved': time(),
+            'accounts': accounts,
+            'prices': {
+                exchange: {symbol: float(price) for symbol, price in prices.items()}
+                for exchange, prices in prices.items()
+            },
+            'unsent': unsent,
+        }, separators=(',', ':'))
+
+    def write(self, state):
+
+        body = self.dump(state)
+
+        with open(self.path + '.tmp', 'w') as f:
+            f.write(body)
+        os.replace(self.path + '.tmp', self.path)
+
+    def save(self, unsent=()):
+
+        ''' Schedule serializing and writing the snapshot in an executor, at most every `interval` seconds '''
+
+        now = time()
+
+        if (self.task and not self.task.done()) or now - self.saved < self.interval:
+            return
+
+        self.saved = now
+        self.unsent = list(unsent)
+
+        self.task = asyncio.ensure_future(self.write_later(self.state()))
+
+    async def write_later(self, state):
+
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, self.write, state)
+        except Exception as e:
+            logger.error(e)
+
+    async def close(self, unsent=()):
+
+        ''' Write the snapshot now, on shutdown, after a write in progress '''
+
+        if self.task:
+            await self.task
+
+        self.unsent = list(unsent)
+        try:
+            self.write(self.state())
+        except Exception as e:
+            logger.error(e)
+
+    def load(self):
+
+        ''' Read the snapshot file, return whether there was a usable one '''
+
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logger.error(e)
+            return False
+
+        if state.get('version') != VERSION:
+            return False
+
+        self.accounts = state['accounts']
+        self.prices = state['prices']
+        self.unsent = [(tuple(key), exchange, text, tuple(confirm) if confirm else None) for key, exchange, text, confirm in state['unsent']]
+        self.stale = set(self.accounts)
+
+        return True
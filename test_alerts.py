@@ -0,0 +1,127 @@
+''' Ranges of Alerts.check() and removal of fired rules '''
+
+from alerts import Alerts
+from clients import Order
+
+def row(id, kind, value, window=0, symbol='ETHBTC', exchange='HitBTC'):
+
+    return (id, exchange, symbol, kind, value, window, 1, None, None)
+
+def fired(alerts, price, now=0, symbol='ETHBTC', exchange='HitBTC'):
+
+    return sorted(rule[0] for rule, at in alerts.check(exchange, {symbol: price}, now))
+
+def test_above_fires_on_previous_exclusive_current_inclusive():
+
+    alerts = Alerts()
+    alerts.load([row(1, 'above', 10), row(2, 'above', 11), row(3, 'above', 12), row(4, 'above', 13)])
+
+    # no previous price, no crossing
+    assert fired(alerts, 10) == []
+    # (10, 12]: 10 is where the price was
+    assert fired(alerts, 12) == [2, 3]
+    # falling crosses nothing above
+    assert fired(alerts, 9) == []
+    assert fired(alerts, 13) == [1, 4]
+
+def test_below_fires_on_current_inclusive_previous_exclusive():
+
+    alerts = Alerts()
+    alerts.load([row(1, 'below', 10), row(2, 'below', 11), row(3, 'below', 12), row(4, 'below', 8)])
+
+    assert fired(alerts, 12) == []
+    # [10, 12)
+    assert fired(alerts, 10) == [1, 2]
+    assert fired(alerts, 13) == []
+    assert fired(alerts, 8) == [3, 4]
+
+def test_equal_price_crosses_nothing():
+
+    alerts = Alerts()
+    alerts.load([row(1, 'above', 10), row(2, 'below', 10)])
+
+    assert fired(alerts, 10) == []
+    assert fired(alerts, 10) == []
+
+def test_move_within_window():
+
+    alerts = Alerts()
+    alerts.load([row(1, 'move', 5, window=60), row(2, 'move', 10, window=60), row(3, 'move', 5, window=600)])
+
+    assert fired(alerts, 100, now=0) == []
+    # 4%
+    assert fired(alerts, 104, now=30) == []
+    # 5% since t=0, within both windows: a move of value fires
+    assert fired(alerts, 105, now=60) == [1, 3]
+    # t=0 left the 60s window, 104 at t=30 is the reference: 9.6%
+    assert fired(alerts, 114, now=90) == []
+    # 105 at t=60 is the reference now
+    assert fired(alerts, 115, now=91) == []
+    assert fired(alerts, 116, now=120) == [2]
+
+def test_move_window_forgets_old_prices():
+
+    alerts = Alerts()
+    alerts.load([row(1, 'move', 5, window=60)])
+
+    assert fired(alerts, 100, now=0) == []
+    assert fired(alerts, 110, now=61) == []
+    assert fired(alerts, 115.5, now=100) == [1]
+
+def test_order_distance():
+
+    alerts = Alerts()
+    alerts.load([row(1, 'order', 1), row(2, 'order', 2), row(3, 'order', 5)])
+    alerts.set_orders('HitBTC', 'HitBTC', [Order(1, 'ETHBTC', 'buy', 1, 100), Order(2, 'ETHBTC', 'sell', 1, 120)])
+    # orders of another exchange do not count
+    alerts.set_orders('Ccex', 'Ccex', [Order(3, 'ETHBTC', 'buy', 1, 104)])
+
+    # 4% from the nearest order
+    assert fired(alerts, 104) == [3]
+    # exactly 2%
+    assert fired(alerts, 102) == [2]
+    assert fired(alerts, 100.5) == [1]
+
+def test_order_without_orders():
+
+    alerts = Alerts()
+    alerts.load([row(1, 'order', 50)])
+
+    assert fired(alerts, 100) == []
+
+def test_fired_rules_are_removed():
+
+    alerts = Alerts()
+    alerts.load([row(1, 'above', 10), row(2, 'move', 1, window=60), row(3, 'below', 5, symbol='LTCBTC')])
+
+    assert fired(alerts, 9, now=0) == []
+    assert fired(alerts, 11, now=1) == [1, 2]
+
+    assert 1 not in alerts.rules and 2 not in alerts.rules
+    assert ('HitBTC', 'ETHBTC') not in alerts.index
+    assert ('HitBTC', 'ETHBTC') not in alerts.history
+    assert alerts.symbols['HitBTC'] == {'LTCBTC'}
+
+    # fires once
+    assert fired(alerts, 9, now=2) == []
+    assert fired(alerts, 12, now=3) == []
+
+def test_remove_keeps_other_rules_of_symbol():
+
+    alerts = Alerts()
+    alerts.load([row(1, 'above', 10), row(2, 'above', 10), row(3, 'below', 5)])
+
+    assert alerts.remove(1)[0] == 1
+    assert alerts.remove(1) is None
+
+    assert fired(alerts, 9) == []
+    assert fired(alerts, 10) == [2]
+    assert fired(alerts, 5) == [3]
+    assert alerts.symbols['HitBTC'] == set()
+
+def test_inactive_rows_not_loaded():
+
+    alerts = Alerts()
+    alerts.load([row(1, 'above', 10)[:6] + (0, None, None)])
+
+    assert alerts.rules == {}
@@ -0,0 +1,296 @@
+''' Circuit breaker state machine, alone and through Exchange.request() '''
+
+import asyncio
+import json
+
+import pytest
+from aiohttp import web
+
+import clients
+from clients import CircuitBreaker, Exchange, Timeout, BadResponse, ApiError, Unavailable, stream_json
+
+class Clock(object):
+
+    def __init__(self):
+
+        self.now = 1000.0
+
+    def __call__(self):
+
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+
+    clock = Clock()
+    monkeypatch.setattr(clients, 'time', clock)
+
+    return clock
+
+def test_opens_after_threshold(clock):
+
+    breaker = CircuitBreaker(threshold=3, cooldown=30)
+
+    for i in range(2):
+        assert breaker.allow()
+        breaker.failure()
+
+    assert breaker.allow()
+    breaker.failure()
+    assert not breaker.allow()
+
+def test_success_resets_failures(clock):
+
+    breaker = CircuitBreaker(threshold=2, cooldown=30)
+
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+
+    assert breaker.allow()
+
+def test_single_probe_after_cooldown(clock):
+
+    breaker = CircuitBreaker(threshold=1, cooldown=30)
+    breaker.failure()
+
+    clock.now += 29
+    assert not breaker.allow()
+
+    clock.now += 1
+    assert breaker.allow()
+    # one probe at a time
+    assert not breaker.allow()
+
+    breaker.success()
+    assert breaker.allow()
+    assert breaker.allow()
+
+def test_failed_probe_reopens(clock):
+
+    breaker = CircuitBreaker(threshold=1, cooldown=30)
+    breaker.failure()
+
+    clock.now += 30
+    assert breaker.allow()
+    breaker.failure()
+    assert not breaker.allow()
+
+    clock.now += 30
+    assert breaker.allow()
+
+class Payload(Exchange):
+
+    ''' Exchange whose 200 answers may be API errors, {"error": ...} '''
+
+    def decode(self, endpoint, status, body):
+
+        jresp = super().decode(endpoint, status, body)
+
+        if 'error' in jresp:
+            raise ApiError('{}: {}'.format(endpoint, jresp['error']))
+
+        return jresp
+
+def serve(handler):
+
+    ''' Return an Exchange on a local server answering with handler, and the runner '''
+
+    async def start():
+        app = web.Application()
+        app.router.add_get('/', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, 'localhost', 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        client = Payload(api_url='http://localhost:{}'.format(port), breaker={'threshold': 1, 'cooldown': 30})
+        return client, runner
+
+    return start()
+
+def run(coroutine):
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.run_until_complete(clients.close_sessions())
+        loop.close()
+        clients._breakers.clear()
+
+def open_circuit(client, clock):
+
+    client.breaker.failure()
+    assert not client.breaker.allow()
+    clock.now += 30
+
+def test_probe_cancelled_by_deadline_settles(clock):
+
+    async def slow(request):
+        await asyncio.sleep(1)
+        return web.json_response({})
+
+    async def main():
+        client, runner = await serve(slow)
+        client.deadlines = {'prices': 0.05}
+        try:
+            open_circuit(client, clock)
+            with pytest.raises(Timeout):
+                await client.timed('prices', client.request('GET', client.api_url, 'slow'))
+            assert not client.breaker.probing
+            assert not client.breaker.allow()
+            clock.now += 30
+            assert client.breaker.allow()
+        finally:
+            await runner.cleanup()
+
+    run(main())
+
+def test_probe_answered_4xx_closes(clock):
+
+    async def forbidden(request):
+        return web.Response(status=403, text='forbidden')
+
+    async def main():
+        client, runner = await serve(forbidden)
+        try:
+            open_circuit(client, clock)
+            with pytest.raises(BadResponse):
+                await client.request('GET', client.api_url, 'forbidden')
+            assert client.breaker.opened is None
+            assert client.breaker.allow()
+        finally:
+            await runner.cleanup()
+
+    run(main())
+
+def test_5xx_opens_and_fails_fast(clock):
+
+    async def broken(request):
+        return web.Response(status=502, text='bad gateway')
+
+    async def main():
+        client, runner = await serve(broken)
+        try:
+            with pytest.raises(BadResponse):
+                await client.request('GET', client.api_url, 'broken')
+            with pytest.raises(Unavailable):
+                await client.request('GET', client.api_url, 'broken')
+        finally:
+            await runner.cleanup()
+
+    run(main())
+
+def test_rate_limited_opens(clock):
+
+    async def limited(request):
+        return web.Response(status=429, text='slow down')
+
+    async def main():
+        client, runner = await serve(limited)
+        try:
+            with pytest.raises(BadResponse):
+                await client.request('GET', client.api_url, 'limited')
+            with pytest.raises(Unavailable):
+                await client.request('GET', client.api_url, 'limited')
+        finally:
+            await runner.cleanup()
+
+    run(main())
+
+def test_api_error_of_signed_request_closes(clock):
+
+    async def invalid_key(request):
+        return web.json_response({'error': 'invalid key'})
+
+    async def main():
+        client, runner = await serve(invalid_key)
+        try:
+            open_circuit(client, clock)
+            with pytest.raises(ApiError):
+                await client.request('GET', client.api_url, 'balance', signed=True)
+            assert client.breaker.opened is None
+            # the same answer to a public request is the exchange's failure
+            with pytest.raises(ApiError):
+                await client.request('GET', client.api_url, 'ticker')
+            assert not client.breaker.allow()
+        finally:
+            await runner.cleanup()
+
+    run(main())
+
+TICKER = json.dumps([
+    {'symbol': 'ETHBTC', 'last': '0.034567', 'volume': 12.5e3},
+    {'symbol': 'LTC\u00e9BTC', 'last': None, 'volume': -1.25e-7},
+    {'symbol': 'XRPBTC', 'last': '0.0000812', 'volume': 100},
+]).encode()
+
+PAIRS = b'{"eth-btc": {"lastprice": 0.034567}, "ltc-btc": {"lastprice": 12}, "xrp-btc": {"lastprice": 1.5e-05}}'
+
+def keep_symbol(item):
+
+    return item['symbol'], item['volume']
+
+def keep_pair(item):
+
+    return item[0], item[1]['lastprice']
+
+def decode(chunks, keep=keep_symbol):
+
+    async def read():
+        for chunk in chunks:
+            yield chunk
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(stream_json(read(), keep))
+    finally:
+        loop.close()
+
+@pytest.mark.parametrize('body, keep', [(TICKER, keep_symbol), (PAIRS, keep_pair)])
+def test_stream_split_anywhere(body, keep):
+
+    expected = decode([body], keep)
+    assert len(expected) == 3
+
+    # keys, strings, numbers and the multi-byte character cut at every byte
+    for i in range(len(body)):
+        assert decode([body[:i], body[i:]], keep) == expected
+
+    assert decode([body[i:i + 1] for i in range(len(body))], keep) == expected
+
+def test_stream_numbers_cut_at_exponent_and_point():
+
+    assert decode([b'[1.', b'5, 2e', b'3, 4E-', b'2, -', b'7]'], lambda item: item) == [1.5, 2e3, 4e-2, -7]
+
+def test_stream_whitespace():
+
+    body = b' \n[ \t{ "symbol" : "A" ,"volume":1 } ,\r\n {"symbol":"B","volume": 2}\n ] \n'
+
+    assert decode([body]) == [('A', 1), ('B', 2)]
+    assert decode([body[i:i + 1] for i in range(len(body))]) == [('A', 1), ('B', 2)]
+
+    pairs = b'{ "a" :\n{"lastprice": 1} , "b":{"lastprice":2}}'
+    assert decode([pairs[i:i + 1] for i in range(len(pairs))], keep_pair) == [('a', 1), ('b', 2)]
+
+def test_stream_keep_none_drops():
+
+    assert decode([TICKER], lambda item: item['symbol'] if item['last'] else None) == ['ETHBTC', 'XRPBTC']
+
+@pytest.mark.parametrize('body', [TICKER, PAIRS])
+def test_stream_truncated(body):
+
+    for i in range(len(body)):
+        with pytest.raises(ValueError):
+            decode([body[:i]], keep_symbol if body is TICKER else keep_pair)
+
+def test_stream_malformed():
+
+    with pytest.raises(ValueError):
+        decode([b'"not a container"'])
+
+    with pytest.raises(ValueError):
+        decode([b'[1 2]'], lambda item: item)
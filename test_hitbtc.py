@@ -0,0 +1,101 @@
+''' HitBTC websocket live view against fakeexchange's websocket '''
+
+import asyncio
+
+import clients
+from fakeexchange import FakeExchange
+from hitbtc import HitBTC
+
+def run(coroutine):
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.run_until_complete(clients.close_sessions())
+        loop.close()
+        clients._breakers.clear()
+
+async def wait_until(condition, timeout=5):
+
+    for i in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+
+    raise AssertionError('timed out')
+
+def streaming(test):
+
+    ''' Run test(fake, client) with client streaming from fake once live '''
+
+    async def main():
+        fake = FakeExchange(symbols=20, balances=3, orders=4, seed=1)
+        await fake.start(port=0)
+        port = fake.runner.addresses[0][1]
+        client = HitBTC(
+            api_url='http://localhost:{}'.format(port),
+            ws_url='ws://localhost:{}/api/2/ws'.format(port),
+            login='k',
+            password='s',
+            stream=True,
+        )
+        try:
+            # polled over REST until the stream is live
+            assert client.get_live_data() is None
+            await wait_until(lambda: client.live)
+            await test(fake, client)
+        finally:
+            await client.close()
+            await fake.stop()
+
+    run(main())
+
+def test_resync_and_subscribe():
+
+    async def test(fake, client):
+        assert set(client.live_orders) == {order['id'] for order in fake.orders}
+        assert [order.id for order in client.live_history] == [order['id'] for order in fake.history]
+        assert len(client.live_prices) == 20
+        assert client.live_balance
+        # tickers of all known symbols, and reports
+        assert fake.tickers == set(client.live_prices)
+        assert len(fake.reporting) == 1
+
+    streaming(test)
+
+def test_report_updates_live_view():
+
+    async def test(fake, client):
+        client.live_balance = {}
+        filled, placed = await fake.execute()
+
+        await wait_until(lambda: placed['id'] in client.live_orders and client.live_balance)
+
+        assert filled['id'] not in client.live_orders
+        assert client.live_history[0].id == filled['id']
+        assert client.live_history[0].status == 'filled'
+
+        data = client.get_live_data()
+        assert {order.id for order in data['orders']} == {order['id'] for order in fake.orders}
+        assert data['balance']
+
+    streaming(test)
+
+def test_reconnect_resyncs():
+
+    async def test(fake, client):
+        for ws in list(fake.reporting):
+            await ws.close()
+        await wait_until(lambda: not client.live)
+
+        # missed while disconnected
+        filled, placed = await fake.execute()
+
+        await wait_until(lambda: client.live)
+        assert set(client.live_orders) == {order['id'] for order in fake.orders}
+        assert filled['id'] in {order.id for order in client.live_history}
+
+    streaming(test)
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  timeseries.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+import asyncio
+import logging
+import os
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+# block of a chunk file: bucket start, number of records
+BLOCK = struct.Struct('<II')
+# record of a block: symbol id, open, high, low, close
+RECORD = struct.Struct('<Idddd')
+
+RESOLUTIONS = (
+    ('1m', 60),
+    ('1h', 3600),
+    ('1d', 86400),
+)
+
+# seconds of buckets per chunk file
+CHUNKS = {
+    '1m': 86400,
+    '1h': 30 * 86400,
+    '1d': 365 * 86400,
+}
+
+# seconds to keep per resolution, None keeps forever
+RETENTION = {
+    '1m': 7 * 86400,
+    '1h': 400 * 86400,
+    '1d': None,
+}
+
+TOTAL = '_total'
+
+logger = logging.getLogger('timeseries')
+
+class TimeSeries(object):
+
+    ''' Append-only OHLC rollups of prices and totals
+
+    Values are aggregated in memory into the open bucket of each (exchange,
+    symbol, resolution). Buckets closing together are appended as one block
+    to the chunk file of their exchange and resolution, which covers
+    CHUNKS[resolution] seconds: a block is the bucket start and its records
+    sorted by symbol id (from the exchange's symbols file), so a query walks
+    the block headers of a chunk and bisects the blocks in range. Retention
+    drops whole chunks.
+
+    File writes, compaction and queries run in order in one thread, off the
+    event loop: add_many() only updates memory and queues closed buckets.
+    '''
+
+    def __init__(self, path='timeseries', retention=None):
+
+        self.path = path
+        self.retention = dict(RETENTION)
+        if retention:
+            self.retention.update(retention)
+        # (exchange, symbol, resolution) -> [start, open, high, low, close]
+        self.buckets = {}
+        # exchange: {symbol: id}, see symbol_ids()
+        self.ids = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='btc-timeseries')
+
+    def directory(self, exchange):
+
+        return os.path.join(self.path, exchange.replace('/', '_'))
+
+    def chunk_name(self, exchange, resolution, start):
+
+        seconds = CHUNKS[resolution]
+
+        return os.path.join(self.directory(exchange), resolution, '{}.bin'.format(int(start // seconds * seconds)))
+
+    def symbol_ids(self, exchange):
+
+        ''' Return {symbol: id} of exchange, reading its symbols file once '''
+
+        with self.lock:
+            ids = self.ids.get(exchange)
+            if ids is None:
+                ids = self.ids[exchange] = {}
+                try:
+                    with open(os.path.join(self.directory(exchange), 'symbols')) as f:
+                        for line in f:
+                            ids[line.rstrip('\n')] = len(ids)
+                except FileNotFoundError:
+                    pass
+
+        return ids
+
+    def symbol_id(self, exchange, symbol):
+
+        ids = self.symbol_ids(exchange)
+
+        if symbol not in ids:
+            with self.lock:
+                os.makedirs(self.directory(exchange), exist_ok=True)
+                with open(os.path.join(self.directory(exchange), 'symbols'), 'a') as f:
+                    f.write(symbol + '\n')
+                ids[symbol] = len(ids)
+
+        return ids[symbol]
+
+    def submit(self, function, *args):
+
+        ''' Run function(*args) in the file thread, after what is queued '''
+
+        future = self.executor.submit(function, *args)
+        future.add_done_callback(self.done)
+
+        return future
+
+    def done(self, future):
+
+        if not future.cancelled() and future.exception():
+            logger.error(repr(future.exception()))
+
+    def add(self, exchange, symbol, value, timestamp=None):
+
+        self.add_many(exchange, {symbol: value}, timestamp)
+
+    def add_many(self, exchange, values, timestamp=None):
+
+        ''' Add {symbol: value} sampled at timestamp '''
+
+        if timestamp is None:
+            timestamp = time()
+
+        closed = []
+
+        for symbol, value in values.items():
+            value = float(value)
+            for resolution, seconds in RESOLUTIONS:
+                start = int(timestamp // seconds * seconds)
+                key = (exchange, symbol, resolution)
+                bucket = self.buckets.get(key)
+
+                if bucket and bucket[0] == start:
+                    bucket[2] = max(bucket[2], value)
+                    bucket[3] = min(bucket[3], value)
+                    bucket[4] = value
+                    continue
+
+                if bucket and bucket[0] < start:
+                    closed.append((key, bucket))
+
+                self.buckets[key] = [start, value, value, value, value]
+
+        if closed:
+            self.submit(self.append, closed)
+
+    def append(self, buckets):
+
+        ''' Write buckets as one block per bucket start, in the file thread '''
+
+        blocks = {}
+        for (exchange, symbol, resolution), bucket in buckets:
+            blocks.setdefault((exchange, resolution, bucket[0]), []).append((self.symbol_id(exchange, symbol), bucket[1:]))
+
+        files = {}
+        for (exchange, resolution, start), records in sorted(blocks.items()):
+            records.sort()
+            files.setdefault(self.chunk_name(exchange, resolution, start), []).append(
+                BLOCK.pack(start, len(records)) + b''.join(RECORD.pack(id, *values) for id, values in records)
+            )
+
+        for filename, data in files.items():
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, 'ab') as f:
+                f.write(b''.join(data))
+
+    def flush(self):
+
+        ''' Queue the open buckets for writing
+
+        They are written again when they close; query() merges records that
+        share a bucket start.
+        '''
+
+        return self.submit(self.append, [(key, list(bucket)) for key, bucket in self.buckets.items()])
+
+    def close(self):
+
+        ''' Write the open buckets and wait for all writes, on shutdown '''
+
+        self.flush()
+        self.executor.shutdown(wait=True)
+
+    async def maintain(self, delay=3600, interval=86400):
+
+        ''' Compact `delay` seconds after startup, then every `interval` '''
+
+        loop = asyncio.get_event_loop()
+
+        while True:
+            await asyncio.sleep(delay)
+            await loop.run_in_executor(self.executor, self.compact)
+            delay = interval
+
+    def search(self, f, offset, size, key):
+
+        ''' Return index of the first of size records at offset whose symbol id is at least key '''
+
+        low, high = 0, size
+        while low < high:
+            middle = (low + high) // 2
+            f.seek(offset + middle * RECORD.size)
+            if RECORD.unpack(f.read(RECORD.size))[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def read(self, exchange, symbol, resolution, start, end):
+
+        ''' Return the rows of symbol within [start, end) in the chunk files '''
+
+        id = self.symbol_ids(exchange).get(symbol)
+        if id is None:
+            return []
+
+        rows = []
+        seconds = CHUNKS[resolution]
+
+        for chunk in range(int(start // seconds * seconds), int(end), seconds):
+            try:
+                f = open(self.chunk_name(exchange, resolution, chunk), 'rb')
+            except FileNotFoundError:
+                continue
+
+            with f:
+                size = os.fstat(f.fileno()).st_size
+                offset = 0
+                while offset + BLOCK.size <= size:
+                    f.seek(offset)
+                    bucket, count = BLOCK.unpack(f.read(BLOCK.size))
+                    records = offset + BLOCK.size
+                    offset = records + count * RECORD.size
+                    # a block cut short by a crash ends the chunk
+                    if offset > size:
+                        break
+                    if not start <= bucket < end:
+                        continue
+
+                    index = self.search(f, records, count, id)
+                    if index < count:
+                        f.seek(records + index * RECORD.size)
+                        record = RECORD.unpack(f.read(RECORD.size))
+                        if record[0] == id:
+                            rows.append([bucket] + list(record[1:]))
+
+        return rows
+
+    def query(self, exchange, symbol, start, end=None, resolution=None, points=500):
+
+        ''' Return [start, open, high, low, close] rows within [start, end)
+
+        Without a resolution the finest one giving at most `points` rows is
+        used. Reads files: run it in the file thread (executor).
+        '''
+
+        if end is None:
+            end = time()
+
+        if resolution is None:
+            resolution = RESOLUTIONS[-1][0]
+            for name, seconds in RESOLUTIONS:
+                if (end - start) / seconds <= points:
+                    resolution = name
+                    break
+
+        rows = self.read(exchange, symbol, resolution, start, end)
+
+        bucket = self.buckets.get((exchange, symbol, resolution))
+        if bucket and start <= bucket[0] < end:
+            rows.append(list(bucket))
+
+        rows.sort(key=lambda row: row[0])
+
+        merged = []
+        for row in rows:
+            if merged and merged[-1][0] == row[0]:
+                previous = merged[-1]
+                previous[2] = max(previous[2], row[2])
+                previous[3] = min(previous[3], row[3])
+                previous[4] = row[4]
+            else:
+                merged.append(row)
+
+        return merged
+
+    def compact(self, now=None):
+
+        ''' Drop chunks older than the retention of their resolution '''
+
+        if now is None:
+            now = time()
+
+        for root, dirs, files in os.walk(self.path):
+            resolution = os.path.basename(root)
+            if not self.retention.get(resolution):
+                continue
+
+            for name in files:
+                stem = name[:-len('.bin')]
+                if name.endswith('.bin') and stem.isdigit() and int(stem) + CHUNKS[resolution] <= now - self.retention[resolution]:
+                    os.remove(os.path.join(root, name))
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  valuation.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+''' Portfolio valuation across exchanges in several base currencies
+
+Tickers of all exchanges form one graph of currencies joined by pairs.
+For every base the shortest conversion path of each currency is found once
+per topology (set of symbols and held currencies) and kept as arrays, so
+a valuation is a few vectorized steps per path length and a single matrix
+product of holdings by conversion rates.
+'''
+
+from collections import deque
+import numpy as np
+
+# quote currencies of concatenated symbols (HitBTC 'ETHBTC')
+QUOTES = ('USDT', 'TUSD', 'EURS', 'DAI', 'BTC', 'ETH', 'USD', 'EOS', 'EUR')
+
+_symbols = {}
+
+def split_symbol(symbol):
+
+    ''' Return (base, quote) of 'ETHBTC' or 'eth-btc', None if unknown '''
+
+    pair = _symbols.get(symbol, False)
+
+    if pair is False:
+        pair = None
+        if '-' in symbol:
+            base, quote = symbol.upper().split('-', 1)
+            pair = (base, quote)
+        else:
+            # 'BTCTUSD' is BTC/TUSD but 'USDTUSD' is USDT/USD: prefer a split
+            # whose base is a known currency (shortest quote first), otherwise
+            # take the longest quote
+            matches = [
+                (symbol[:-len(quote)] in QUOTES, -len(quote) if symbol[:-len(quote)] in QUOTES else len(quote), quote)
+                for quote in QUOTES
+                if symbol.endswith(quote) and len(symbol) > len(quote)
+            ]
+            if matches:
+                quote = max(matches)[2]
+                pair = (symbol[:-len(quote)], quote)
+        _symbols[symbol] = pair
+
+    return pair
+
+class Valuation(object):
+
+    def __init__(self, bases=('BTC', 'USD', 'ETH')):
+
+        self.bases = tuple(bases)
+        self.prices = {}
+        self.balances = {}
+        self.topology = None
+
+    def set_prices(self, exchange, prices):
+
+        if prices:
+            self.prices[exchange] = prices
+
+    def set_balance(self, account, balance):
+
+        self.balances[account] = balance
+
+    def build(self):
+
+        ''' Index currencies and pairs and resolve conversion paths '''
+
+        layouts = {}
+        pairs = {}
+        currencies = {}
+
+        def index(currency):
+            return currencies.setdefault(currency, len(currencies))
+
+        for base in self.bases:
+            index(base)
+
+        for exchange, prices in self.prices.items():
+            positions = []
+            keep = []
+            for position, symbol in enumerate(prices):
+                pair = split_symbol(symbol)
+                if pair:
+                    pair = (index(pair[0]), index(pair[1]))
+                    positions.append(pairs.setdefault(pair, len(pairs)))
+                    keep.append(position)
+            layouts[exchange] = (tuple(prices), np.array(keep, dtype=np.intp), np.array(positions, dtype=np.intp))
+
+        for balance in self.balances.values():
+            for currency in balance:
+                index(currency.upper())
+
+        neighbours = [[] for currency in currencies]
+        for (base, quote), pair in pairs.items():
+            # value(base) = price * value(quote), value(quote) = value(base) / price
+            neighbours[quote].append((base, pair, True))
+            neighbours[base].append((quote, pair, False))
+
+        paths = []
+        for target in self.bases:
+            levels = []
+            seen = {currencies[target]}
+            frontier = deque([currencies[target]])
+            while frontier:
+                level = []
+                for i in range(len(frontier)):
+                    node = frontier.popleft()
+                    for child, pair, direct in neighbours[node]:
+                        if child not in seen:
+                            seen.add(child)
+                            frontier.append(child)
+                            level.append((child, node, pair, direct))
+                if level:
+                    levels.append(tuple(np.array(column) for column in zip(*level)))
+            paths.append(levels)
+
+        self.topology = {
+            'key': self.key(),
+            'layouts': layouts,
+            'currencies': currencies,
+            'pairs': len(pairs),
+            'paths': paths,
+        }
+
+    def key(self):
+
+        return (
+            tuple((exchange, tuple(prices)) for exchange, prices in self.prices.items()),
+            tuple(sorted({currency.upper() for balance in self.balances.values() for currency in balance})),
+        )
+
+    def rates(self):
+
+        ''' Return the mean price of every pair across exchanges '''
+
+        topology = self.topology
+        sums = np.zeros(topology['pairs'])
+        counts = np.zeros(topology['pairs'])
+
+        for exchange, prices in self.prices.items():
+            symbols, keep, positions = topology['layouts'][exchange]
+            values = np.fromiter(prices.values(), dtype=float, count=len(prices))[keep]
+            valid = values > 0
+            sums += np.bincount(positions[valid], weights=values[valid], minlength=topology['pairs'])
+            counts += np.bincount(positions[valid], minlength=topology['pairs'])
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(counts > 0, sums / counts, 0)
+
+    def conversions(self, rates):
+
+        ''' Return bases x currencies matrix of currency values in each base '''
+
+        topology = self.topology
+        matrix = np.zeros((len(self.bases), len(topology['currencies'])))
+
+        for row, (base, levels) in enumerate(zip(self.bases, topology['paths'])):
+            values = matrix[row]
+            values[topology['currencies'][base]] = 1
+            for children, parents, pairs, direct in levels:
+                rate = rates[pairs]
+                with np.errstate(divide='ignore'):
+                    factor = np.where(direct, rate, np.where(rate > 0, 1 / rate, 0))
+                values[children] = values[parents] * factor
+
+        return matrix
+
+    def compute(self):
+
+        ''' Value every account and their sum in every base
+
+        Return {'accounts': {account: {base: value}}, 'total': {base: value},
+        'unpriced': {account: [currency]}}.
+        '''
+
+        if not self.topology or self.topology['key'] != self.key():
+            self.build()
+
+        currencies = self.topology['currencies']
+        conversions = self.conversions(self.rates())
+
+        accounts = list(self.balances)
+        holdings = np.zeros((len(accounts), len(currencies)))
+        for row, account in enumerate(accounts):
+            for currency, balance in self.balances[account].items():
+                holdings[row, currencies[currency.upper()]] = float(balance.available + balance.reserved)
+
+        values = holdings @ conversions.T
+        missing = (holdings > 0) & (conversions[0] == 0)
+        names = list(currencies)
+
+        return {
+            'accounts': {
+                account: dict(zip(self.bases, values[row].tolist()))
+                for row, account in enumerate(accounts)
+            },
+            'total': dict(zip(self.bases, values.sum(axis=0).tolist())),
+            'unpriced': {
+                account: [names[i] for i in np.flatnonzero(missing[row])]
+                for row, account in enumerate(accounts)
+                if missing[row].any()
+            },
+        }
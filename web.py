@@ -1,26 +1,414 @@
 from aiohttp import web
 import db
+import metrics
+from clients import offload
+from alerts import COLUMNS as ALERT_COLUMNS, KINDS as ALERT_KINDS
 import aiohttp_jinja2
 from jinja2 import FileSystemLoader
+import asyncio
+import gzip
+import hashlib
+import json
+from collections import deque
+from functools import partial
+from time import time
 
 routes = web.RouteTableDef()
 
+COLUMNS = {
+    'orders': ('id', 'exchange', 'symbol', 'side', 'price', 'quantity'),
+    'prices': ('exchange', 'symbol', 'price'),
+    'history': ('id', 'exchange', 'symbol', 'side', 'price', 'quantity', 'confirmed'),
+    'near': ('id', 'exchange', 'symbol', 'side', 'price', 'quantity', 'market', 'distance'),
+}
+
+# most recent fills served by /api/history
+HISTORY_LIMIT = 500
+
+def source(table):
+
+    ''' Return (key columns, columns) of the rows db publishes for table '''
+
+    if table in db.TABLES:
+        return db.TABLES[table]
+
+    return ('id', 'exchange'), COLUMNS[table]
+
+def reorder(table):
+
+    ''' Return the indexes turning a published row into COLUMNS order '''
+
+    columns = source(table)[1]
+
+    return [columns.index(column) for column in COLUMNS[table]]
+
+class Cache(object):
+
+    ''' Last snapshot of the tables and the responses rendered from it
+
+    The tables are read once by load(), then kept up to date from the
+    change sets db publishes (apply()), history limited to its last
+    HISTORY_LIMIT fills. The poller calls refresh() after each write,
+    requests are served from memory. Rendered bodies are kept until the
+    next refresh together with their gzipped form and an ETag.
+    '''
+
+    def __init__(self):
+
+        self.data = {'orders': [], 'prices': [], 'history': [], 'valuation': {}, 'near': [], 'status': {}}
+        self.entries = {}
+        # table: {key as in db.TABLES: row as in COLUMNS}
+        self.rows = {'orders': {}, 'prices': {}}
+        self.history = deque(maxlen=HISTORY_LIMIT)
+        self.changed = False
+
+    def key(self, table, row):
+
+        return tuple(row[COLUMNS[table].index(column)] for column in source(table)[0])
+
+    async def load(self):
+
+        for table, rows in (('orders', await db.get_orders()), ('prices', await db.get_prices())):
+            self.rows[table] = {self.key(table, row): tuple(row) for row in rows}
+
+        self.history.clear()
+        self.history.extend(await db.get_history(limit=HISTORY_LIMIT))
+        self.changed = True
+
+    def apply(self, table, name, changes):
+
+        ''' db listener, see db.subscribe() '''
+
+        if table == 'history':
+            updated = changes['updated']
+            for i, row in enumerate(self.history):
+                key = (row[0], row[1])
+                if key in updated:
+                    self.history[i] = updated[key]
+            self.history.extend(changes['inserted'].values())
+        elif table in self.rows:
+            rows = self.rows[table]
+            order = reorder(table)
+            for key in changes['removed']:
+                rows.pop(key, None)
+            for changed in (changes['inserted'], changes['updated']):
+                for key, row in changed.items():
+                    rows[key] = tuple(row[i] for i in order)
+        else:
+            return
+
+        self.changed = True
+
+    def refresh(self):
+
+        if self.changed:
+            self.changed = False
+            self.update(
+                orders=list(self.rows['orders'].values()),
+                prices=list(self.rows['prices'].values()),
+                history=list(self.history),
+            )
+
+    def update(self, **data):
+
+        self.data.update(data)
+        self.entries = {}
+
+    async def get(self, name, render):
+
+        entries = self.entries
+        entry = entries.get(name)
+
+        if entry is None:
+            # an update() while rendering elsewhere leaves this entry behind
+            entry = entries[name] = await offload('render', self.build, render, self.data)
+
+        return entry
+
+    def build(self, render, data):
+
+        body = render(data)
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+
+        return body, gzip.compress(body), etag
+
+cache = Cache()
+
+class Feed(object):
+
+    ''' Bounded buffer of change events shared by all live connections
+
+    Each change set from db is serialized once and appended to the buffer,
+    rows as objects keyed by COLUMNS like /api/*, removed keys by their
+    key columns.
+    Connections read from it at their own pace; one that falls further
+    behind than the buffer holds gets a 'reset' event and should reload
+    from /api/*.
+    '''
+
+    def __init__(self, size=256):
+
+        self.events = deque(maxlen=size)
+        self.seq = 0
+        self.changed = asyncio.Event()
+
+    def publish(self, table, name, changes):
+
+        keys = source(table)[0]
+        columns = COLUMNS[table]
+        order = reorder(table)
+
+        def rows(changed):
+            return [dict(zip(columns, (row[i] for i in order))) for row in changed.values()]
+
+        self.seq += 1
+        event = json.dumps({
+            'table': table,
+            'exchange': name,
+            'inserted': rows(changes['inserted']),
+            'updated': rows(changes['updated']),
+            'removed': [dict(zip(keys, key)) for key in changes['removed']],
+        })
+        self.events.append((self.seq, event))
+
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def follow(self, cursor=None, keepalive=15):
+
+        ''' Yield (seq, event) after cursor, or (None, None) on idle keepalive '''
+
+        if cursor is None or cursor > self.seq:
+            cursor = self.seq
+
+        while True:
+            if cursor == self.seq:
+                try:
+                    await asyncio.wait_for(self.changed.wait(), keepalive)
+                except asyncio.TimeoutError:
+                    yield None, None
+                continue
+
+            if cursor + 1 < self.events[0][0]:
+                cursor = self.seq
+                yield cursor, json.dumps({'table': 'reset'})
+                continue
+
+            for seq, event in list(self.events):
+                if seq > cursor:
+                    cursor = seq
+                    yield seq, event
+
+feed = Feed()
+
+async def refresh():
+
+    cache.refresh()
+
+async def cached_response(request, name, content_type, render):
+
+    body, gzipped, etag = await cache.get(name, render)
+
+    headers = {'ETag': etag, 'Vary': 'Accept-Encoding', 'Cache-Control': 'no-cache'}
+
+    if etag in request.headers.get('If-None-Match', ''):
+        return web.Response(status=304, headers=headers)
+
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        headers['Content-Encoding'] = 'gzip'
+        body = gzipped
+
+    return web.Response(body=body, content_type=content_type, charset='utf-8', headers=headers)
+
+def render_json(table):
+
+    columns = COLUMNS[table]
+
+    def render(data):
+        return json.dumps([dict(zip(columns, row)) for row in data[table]]).encode()
+
+    return render
+
 @routes.get('/')
 async def index(request):
-    orders = await db.get_orders()
-    prices = await db.get_prices()
-    context = {'orders': orders, 'prices': prices}
-    response = aiohttp_jinja2.render_template("index.html", request, context)
+
+    def render(data):
+        stale = sorted(name for name, status in data['status'].items() if status['stale'])
+        context = {'orders': data['orders'], 'prices': data['prices'], 'near': data['near'], 'stale': stale}
+        return aiohttp_jinja2.render_string("index.html", request, context).encode()
+
+    return await cached_response(request, 'index', 'text/html', render)
+
+@routes.get('/api/orders')
+async def api_orders(request):
+    return await cached_response(request, 'orders', 'application/json', render_json('orders'))
+
+@routes.get('/api/prices')
+async def api_prices(request):
+    return await cached_response(request, 'prices', 'application/json', render_json('prices'))
+
+@routes.get('/api/history')
+async def api_history(request):
+    return await cached_response(request, 'history', 'application/json', render_json('history'))
+
+@routes.get('/api/near')
+async def api_near(request):
+    return await cached_response(request, 'near', 'application/json', render_json('near'))
+
+@routes.get('/api/valuation')
+async def api_valuation(request):
+
+    def render(data):
+        return json.dumps(data['valuation']).encode()
+
+    return await cached_response(request, 'valuation', 'application/json', render)
+
+@routes.get('/api/status')
+async def api_status(request):
+
+    ''' {account: {exchange, updated, total, stale}}, stale until its first cycle after a restart '''
+
+    def render(data):
+        return json.dumps(data['status']).encode()
+
+    return await cached_response(request, 'status', 'application/json', render)
+
+@routes.get('/api/series')
+async def api_series(request):
+
+    ''' ?exchange=&symbol=[&start=&end=&resolution=&points=], times in unix seconds '''
+
+    try:
+        exchange = request.query['exchange']
+        symbol = request.query['symbol']
+        end = float(request.query.get('end', time()))
+        start = float(request.query.get('start', end - 86400))
+        points = int(request.query.get('points', 500))
+    except (KeyError, ValueError) as e:
+        raise web.HTTPBadRequest(text=str(e))
+
+    if not request.app['series']:
+        raise web.HTTPNotFound()
+
+    series = request.app['series']
+    rows = await asyncio.get_event_loop().run_in_executor(
+        series.executor,
+        partial(series.query, exchange, symbol, start, end, resolution=request.query.get('resolution'), points=points),
+    )
+
+    return web.json_response(rows)
+
+@routes.get('/api/alerts')
+async def api_alerts(request):
+
+    return web.json_response([dict(zip(ALERT_COLUMNS, row)) for row in await db.get_alerts()])
+
+@routes.post('/api/alerts')
+async def api_add_alert(request):
+
+    ''' {"exchange", "symbol", "kind": above|below|move|order, "value"[, "window"]} '''
+
+    try:
+        alert = await request.json()
+        exchange = str(alert['exchange'])
+        symbol = str(alert['symbol'])
+        kind = alert['kind']
+        value = float(alert['value'])
+        window = int(alert.get('window', 0))
+    except (KeyError, TypeError, ValueError) as e:
+        raise web.HTTPBadRequest(text=str(e))
+
+    if kind not in ALERT_KINDS or value < 0 or (kind == 'move' and window <= 0):
+        raise web.HTTPBadRequest(text='kind is one of {}, value >= 0, moves need a window'.format(', '.join(ALERT_KINDS)))
+
+    row = await db.add_alert(exchange, symbol, kind, value, window)
+    if request.app['alerts'] is not None:
+        request.app['alerts'].add(row)
+
+    return web.json_response(dict(zip(ALERT_COLUMNS, row)), status=201)
+
+@routes.delete('/api/alerts/{id}')
+async def api_remove_alert(request):
+
+    try:
+        alert_id = int(request.match_info['id'])
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+
+    await db.remove_alert(alert_id)
+    if request.app['alerts'] is not None:
+        request.app['alerts'].remove(alert_id)
+
+    return web.Response(status=204)
+
+@routes.get('/metrics')
+async def metrics_page(request):
+
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8', headers={'X-Content-Type-Options': 'nosniff'})
+
+@routes.get('/events')
+async def events(request):
+
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+    await response.prepare(request)
+
+    cursor = request.headers.get('Last-Event-ID')
+    cursor = int(cursor) if cursor and cursor.isdigit() else None
+
+    try:
+        async for seq, event in feed.follow(cursor):
+            if seq is None:
+                await response.write(b': keepalive\n\n')
+            else:
+                await response.write('id: {}\ndata: {}\n\n'.format(seq, event).encode())
+    except ConnectionResetError:
+        # the client went away
+        pass
+
     return response
 
-async def web_app():
+@routes.get('/ws')
+async def websocket(request):
+
+    ws = web.WebSocketResponse(heartbeat=30)
+    await ws.prepare(request)
+
+    async def push():
+        async for seq, event in feed.follow():
+            if seq is not None:
+                await ws.send_str(event)
+
+    pusher = asyncio.ensure_future(push())
+
+    try:
+        # incoming messages are ignored, reading handles close and pings
+        async for msg in ws:
+            pass
+    finally:
+        pusher.cancel()
+        # retrieve how the pusher ended, e.g. sending to a closed socket
+        await asyncio.gather(pusher, return_exceptions=True)
+
+    return ws
+
+async def web_app(series=None, alerts=None):
 
     app = web.Application()
+    app['series'] = series
+    app['alerts'] = alerts
     app.add_routes(routes)
 
     aiohttp_jinja2.setup(app, loader=FileSystemLoader(''))
 
+    await cache.load()
+    await refresh()
+    db.subscribe(cache.apply)
+    db.subscribe(feed.publish)
+    metrics.QUEUE_SIZE.set_function(lambda: len(feed.events), queue='feed')
+
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, 'localhost', 8080)
     await site.start()
+
+    return runner